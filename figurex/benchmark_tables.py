@@ -0,0 +1,158 @@
+"""
+Compares the iterrows loops that used to build the tables of the pipeline with their vectorized replacements, on
+synthetic tables. Only the table building is timed, not the file operations around it.
+
+Usage:
+    script.py [options]
+
+Options:
+    --rows <list>   Comma-separated numbers of rows [default: 10000,100000,1000000]
+    --seed <int>    Random seed [default: 0]
+"""
+
+import copy
+import re
+import time
+
+import docopt
+import numpy as np
+import pandas as pd
+
+from figurex.collect_gold_standard import label_subfigures
+from figurex.collect_predictions_to_check import images_to_copy
+from figurex.get_figures import figure_filenames
+from figurex.gold_standard_to_publish_json import iter_figures
+from figurex.split_figures import subfigure_rows
+
+LABELS = np.array(['ct', 'cxr', 'nature'])
+
+
+def make_figure_df(n, rng):
+    return pd.DataFrame({
+        'pmcid': ['PMC%d' % i for i in rng.integers(1, max(n // 5, 2), n)],
+        'figure url': ['fig%d.jpg' % i for i in rng.integers(1, 10, n)],
+    })
+
+
+def make_subfigure_df(n, rng):
+    df = make_figure_df(n, rng)
+    boxes = rng.integers(0, 1000, (n, 4))
+    whole = rng.random(n) < 0.3
+    df['figure filename'] = df['pmcid'] + '_' + df['figure url']
+    df['subfigure filename'] = [f'{f[:-4]}_{b[0]}x{b[1]}_{b[2]}x{b[3]}.jpg' if not w else f
+                                for f, b, w in zip(df['figure filename'], boxes, whole)]
+    df['prediction'] = LABELS[rng.integers(0, 3, n)]
+    df['label'] = LABELS[rng.integers(0, 3, n)]
+    df['insert_time'] = '05092020'
+    return df
+
+
+def old_get_figures(figure_df):
+    data = []
+    for _, row in figure_df.iterrows():
+        row['figure filename'] = '{}_{}'.format(row['pmcid'], row['figure url'])
+        data.append(row)
+    return pd.DataFrame(data)
+
+
+def new_get_figures(figure_df):
+    return figure_df.assign(**{'figure filename': figure_filenames(figure_df)})
+
+
+def old_split_figures(figure_df, filenames):
+    data = []
+    for (_, row), names in zip(figure_df.iterrows(), filenames):
+        for name in names:
+            x = copy.deepcopy(row)
+            x['subfigure filename'] = name
+            data.append(x)
+    return pd.DataFrame(data)
+
+
+def old_collect_gold_standard(df, gs, insert_time):
+    data = []
+    for _, row in df.iterrows():
+        subfig = row['subfigure filename']
+        row['label'] = gs[subfig] if subfig in gs else 'nature'
+        row['insert_time'] = insert_time
+        data.append(row)
+    return pd.DataFrame(data)
+
+
+def old_collect_predictions(df, gs, skip_gold=True):
+    data = []
+    for _, row in df.iterrows():
+        subfig = row['subfigure filename']
+        if subfig in gs:
+            if skip_gold:
+                continue
+            prediction = gs[subfig]
+        else:
+            prediction = row['prediction']
+        if prediction in ['cxr', 'ct']:
+            data.append((subfig, prediction))
+    return pd.DataFrame(data, columns=['subfigure filename', 'prediction'])
+
+
+def old_gold_to_publish(df):
+    figures = {}
+    for _, row in df.iterrows():
+        pmc = row['pmcid']
+        url = f'https://www.ncbi.nlm.nih.gov/pmc/articles/{pmc}/bin/{row["figure url"]}'
+        if url not in figures:
+            figures[url] = {'pmcid': pmc, 'url': url, 'insert_time': row['insert_time']}
+        figure = figures[url]
+        m = re.search(r'(\d+)x(\d+)_(\d+)x(\d+)', row['subfigure filename'])
+        if m:
+            if 'box' not in figure:
+                figure['box'] = []
+            figure['box'].append({'xtl': int(m.group(1)), 'ytl': int(m.group(2)), 'xbr': int(m.group(3)),
+                                  'ybr': int(m.group(4)), 'label': row['label']})
+        elif 'box' not in figure:
+            figure['label'] = row['label']
+    return sorted(figures.values(), key=lambda x: (x['pmcid'], x['url']))
+
+
+def new_gold_to_publish(df):
+    return list(iter_figures(df.sort_values(['pmcid', 'figure url'], kind='mergesort')))
+
+
+def assert_same_table(old, new):
+    pd.testing.assert_frame_equal(old.reset_index(drop=True), new.reset_index(drop=True), check_dtype=False)
+
+
+def timeit(f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    return result, time.perf_counter() - start
+
+
+def benchmark(n, rng):
+    figure_df = make_figure_df(n, rng)
+    subfigure_df = make_subfigure_df(n, rng)
+    gs = dict(zip(subfigure_df['subfigure filename'].sample(frac=0.5, random_state=0),
+                  LABELS[rng.integers(0, 2, n)]))
+    filenames = [['a.jpg', 'b.jpg', 'c.jpg'][:k] for k in rng.integers(0, 4, n)]
+    cases = [
+        ('get_figures', old_get_figures, new_get_figures, (figure_df,), assert_same_table),
+        ('split_figures', old_split_figures, subfigure_rows, (figure_df, filenames), assert_same_table),
+        ('collect_gold_standard', old_collect_gold_standard, label_subfigures, (subfigure_df, gs, '05092020'),
+         assert_same_table),
+        ('collect_predictions_to_check', old_collect_predictions, images_to_copy, (subfigure_df, gs),
+         assert_same_table),
+        ('gold_standard_to_publish_json', old_gold_to_publish, new_gold_to_publish, (subfigure_df,),
+         lambda old, new: np.testing.assert_equal(old, new)),
+    ]
+    for name, old_f, new_f, args, check in cases:
+        old, old_time = timeit(old_f, *args)
+        new, new_time = timeit(new_f, *args)
+        check(old, new)
+        print('%s rows : %d, iterrows : %.2fs, vectorized : %.2fs, speedup : %.1fx'
+              % (name, n, old_time, new_time, old_time / max(new_time, 1e-9)))
+
+
+if __name__ == '__main__':
+    args = docopt.docopt(__doc__)
+    rng = np.random.default_rng(int(args['--seed']))
+    for n in args['--rows'].split(','):
+        benchmark(int(n), rng)
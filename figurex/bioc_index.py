@@ -0,0 +1,203 @@
+"""
+Usage:
+    script.py [options] -i SOURCE -b BIOC_DIR -o INDEX
+
+Options:
+    -i <file>       PMC csv file
+    -b <dir>        BioC folder
+    -o <file>       BioC index file
+"""
+
+import collections
+import json
+import os
+import re
+import sqlite3
+from pathlib import Path
+from typing import Dict, List, Set
+
+import bioc
+import docopt
+import tqdm
+
+from figurex.utils import is_file_not_empty, read_table
+
+FIG_ID = re.compile(r'(\d)+$')
+# "Fig 1", "Fig. 1", "Figure 3a", "Figs. 2-4", "Figures 2 and 3", "Fig. 2, 5", "Figures 1, 2, and 3"
+FIG_REFERENCE = re.compile(r'\b[Ff]ig(?:ure)?(s?)\.?\s*(\d+)[A-Za-z]?\b'
+                           r'((?:\s*(?:[-\u2013\u2014]|to|,?\s*(?:and|&)|,)\s*\d+[A-Za-z]?\b)*)')
+# one more number of a list or a range, the range separator in group 1, and a comma without "and" in group 2
+FIG_REFERENCE_PART = re.compile(r'\s*(?:([-\u2013\u2014]|to)|,?\s*(?:and|&)|(,))\s*(\d+)[A-Za-z]?\b')
+# a number after a comma and followed by a word, as in "Figure 4, 12 patients", ends the list of a singular "Fig" or
+# "Figure"
+FOLLOWED_BY_WORD = re.compile(r'\s+(?!(?:and|to)\b)[A-Za-z]')
+# longest "Figs. 2-4" range that is expanded
+MAX_FIGURE_RANGE = 20
+# larger numbers in a list or a range are not figures, e.g. "Figure 5, 2019-2020"
+MAX_FIGURE_NUMBER = 99
+INDEX_VERSION = 4
+
+
+def referred_figures(text) -> Set[int]:
+    """
+    Figure numbers referred to in a text, in a single scan. Ranges such as "Figs. 2-4" refer to every figure of the
+    range, and panels such as "Figure 3a" to their figure. "Fig 10" refers to figure 10 only.
+
+    >>> sorted(referred_figures('Figs. 2-4, Figures 6 and 7, Fig. 9, 11 and Figure 3a'))
+    [2, 3, 4, 6, 7, 9, 11]
+    >>> sorted(referred_figures('Fig 10'))
+    [10]
+    >>> sorted(referred_figures('as in Figure 4, 120 patients'))
+    [4]
+    >>> sorted(referred_figures('as in Figure 4, 12 patients'))
+    [4]
+    >>> sorted(referred_figures('Figure 5, 2019-2020'))
+    [5]
+    >>> sorted(referred_figures('Figure 1 and 2 show'))
+    [1, 2]
+    >>> sorted(referred_figures('Figure 1, 2 and 3 show'))
+    [1, 2, 3]
+    >>> sorted(referred_figures('Figures 1, 2, 3, and 4'))
+    [1, 2, 3, 4]
+    """
+    numbers = set()
+    for m in FIG_REFERENCE.finditer(text):
+        previous = int(m.group(2))
+        numbers.add(previous)
+        for part in FIG_REFERENCE_PART.finditer(text, m.start(3), m.end(3)):
+            number = int(part.group(3))
+            if number > MAX_FIGURE_NUMBER:
+                break
+            if part.group(1) is not None:
+                if 0 < number - previous <= MAX_FIGURE_RANGE:
+                    numbers.update(range(previous + 1, number + 1))
+                else:
+                    numbers.add(number)
+            elif not m.group(1) and part.group(2) is not None and FOLLOWED_BY_WORD.match(text, part.end()):
+                break
+            else:
+                numbers.add(number)
+            previous = number
+    return numbers
+
+
+def figure_number(figure_id):
+    m = FIG_ID.search(figure_id)
+    return str(int(m.group())) if m else None
+
+
+class BiocIndex:
+    """
+    On-disk index of the figure passages of BioC articles, and of the passages that refer to each figure. Each article
+    is parsed once per version of its BioC file, after which get_figure_url and get_figure_text become lookups.
+    """
+
+    def __init__(self, pathname):
+        self.conn = sqlite3.connect(str(pathname))
+        if self.conn.execute('PRAGMA user_version').fetchone()[0] != INDEX_VERSION:
+            # indexed with another figure reference matcher
+            self.conn.executescript('DROP TABLE IF EXISTS articles; DROP TABLE IF EXISTS passages; '
+                                    'DROP TABLE IF EXISTS mentions; PRAGMA user_version = %d;' % INDEX_VERSION)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS articles (pmcid TEXT PRIMARY KEY, mtime REAL, size INTEGER);
+            CREATE TABLE IF NOT EXISTS passages (pmcid TEXT, document INTEGER, seq INTEGER, offset INTEGER,
+                                                 infons TEXT, text TEXT, file TEXT, figure TEXT,
+                                                 PRIMARY KEY (pmcid, document, seq));
+            CREATE INDEX IF NOT EXISTS passages_file ON passages (pmcid, file);
+            CREATE TABLE IF NOT EXISTS mentions (pmcid TEXT, document INTEGER, figure TEXT, seq INTEGER);
+            CREATE INDEX IF NOT EXISTS mentions_figure ON mentions (pmcid, document, figure);
+        """)
+
+    def close(self):
+        self.conn.close()
+
+    def update(self, pmcids, bioc_dir):
+        """Indexes the articles that are new or whose BioC file changed since they were indexed."""
+        indexed = {pmcid: (mtime, size) for pmcid, mtime, size in self.conn.execute('SELECT * FROM articles')}
+        cnt = collections.Counter()
+        for pmcid in tqdm.tqdm(pmcids, desc='Index BioC'):
+            bioc_file = bioc_dir / f'{pmcid}.xml'
+            if not is_file_not_empty(bioc_file):
+                continue
+            stat = os.stat(bioc_file)
+            if indexed.get(pmcid) == (stat.st_mtime, stat.st_size):
+                cnt['indexed'] += 1
+                continue
+            self.index_article(pmcid, bioc_file, stat)
+            cnt['new index'] += 1
+        return cnt
+
+    def index_article(self, pmcid, bioc_file, stat=None):
+        stat = stat if stat is not None else os.stat(bioc_file)
+        with open(bioc_file, encoding='utf8') as fp:
+            collection = bioc.load(fp)
+
+        passages = []
+        mentions = []
+        for document, doc in enumerate(collection.documents):
+            for seq, p in enumerate(doc.passages):
+                numbers = referred_figures(p.text)
+                mentions.extend((pmcid, document, str(number), seq) for number in numbers)
+                has_file = len(p.text) != 0 and 'file' in p.infons
+                if has_file or numbers:
+                    figure = figure_number(p.infons['id']) if has_file and 'id' in p.infons else None
+                    passages.append((pmcid, document, seq, p.offset, json.dumps(p.infons), p.text,
+                                     p.infons['file'] if has_file else None, figure))
+
+        with self.conn:
+            for table in ('articles', 'passages', 'mentions'):
+                self.conn.execute(f'DELETE FROM {table} WHERE pmcid = ?', (pmcid,))
+            self.conn.executemany('INSERT INTO passages VALUES (?, ?, ?, ?, ?, ?, ?, ?)', passages)
+            self.conn.executemany('INSERT INTO mentions VALUES (?, ?, ?, ?)', mentions)
+            self.conn.execute('INSERT INTO articles VALUES (?, ?, ?)', (pmcid, stat.st_mtime, stat.st_size))
+
+    def has_article(self, pmcid):
+        return self.conn.execute('SELECT 1 FROM articles WHERE pmcid = ?', (pmcid,)).fetchone() is not None
+
+    def figure_passages(self, pmcid) -> List[Dict]:
+        """Passages of an article with a "file" infon and some text, in document order."""
+        cursor = self.conn.execute('SELECT infons, text FROM passages WHERE pmcid = ? AND file IS NOT NULL '
+                                   'ORDER BY document, seq', (pmcid,))
+        return [{'infons': json.loads(infons), 'text': text} for infons, text in cursor]
+
+    def figure_text(self, pmcid, filename) -> List[bioc.BioCPassage]:
+        """
+        Same passages as get_figure_text.get_figure_caption: in each document, the first passage of the figure file
+        followed by the passages referring to the figure.
+        """
+        passages = []
+        cursor = self.conn.execute('SELECT document, MIN(seq), figure FROM passages WHERE pmcid = ? AND file = ? '
+                                   'GROUP BY document ORDER BY document', (pmcid, filename))
+        for document, seq, figure in cursor.fetchall():
+            passages.append(self._passage(pmcid, document, seq))
+            if figure is None:
+                continue
+            for (referred,) in self.conn.execute('SELECT seq FROM mentions WHERE pmcid = ? AND document = ? '
+                                                 'AND figure = ? ORDER BY seq', (pmcid, document, figure)):
+                passages.append(self._passage(pmcid, document, referred))
+        return passages
+
+    def _passage(self, pmcid, document, seq) -> bioc.BioCPassage:
+        offset, infons, text = self.conn.execute('SELECT offset, infons, text FROM passages WHERE pmcid = ? '
+                                                 'AND document = ? AND seq = ?', (pmcid, document, seq)).fetchone()
+        passage = bioc.BioCPassage()
+        passage.offset = offset
+        passage.infons = json.loads(infons)
+        passage.text = text
+        return passage
+
+
+def index_bioc_f(src, bioc_dir, index_pathname):
+    df = read_table(src, columns=['pmcid'], dtype=str)
+    index = BiocIndex(index_pathname)
+    cnt = index.update(df['pmcid'], bioc_dir)
+    index.close()
+    for k, v in cnt.most_common():
+        print(k, ':', v)
+
+
+if __name__ == '__main__':
+    args = docopt.docopt(__doc__)
+    index_bioc_f(src=Path(args['-i']),
+                 bioc_dir=Path(args['-b']),
+                 index_pathname=Path(args['-o']))
@@ -1,47 +1,110 @@
 """
 Usage:
-    script.py [options] -i SOURCE -o DEST -f FIGURE_DIR -m MODEL_FILE -l history
+    script.py [options] -i SOURCE -o DEST -f FIGURE_DIR -m MODEL_FILE [-l history]
 
 Options:
     -i <file>       Subfigure csv file
     -o <file>       Prediction csv file
-    -f <dir>        figure dir
+    -f <dir>        subfigure store or shard dir, shards only with --stream
     -m <file>       model path
     -l <file>       history csv file
+    --stream            Predict in a streaming pipeline and append the predictions with their scores to DEST
+    --batch-size <int>  Number of images per batch [default: 32]
+    --workers <int>     Number of image loading threads, with --stream [default: 4]
+    --cache <file>      Prediction cache keyed by image and model content, with --stream
 """
 
-import os
+import collections
+import io
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import docopt
 import numpy as np
 import pandas as pd
+import tqdm
+from PIL import Image
 from keras.applications import densenet
 from keras.models import load_model
 from keras.preprocessing.image import ImageDataGenerator
 
+from figurex.figure_store import ShardStore, open_store
+from figurex.utils import append_table, file_hash, read_table, write_table
 
-def detect_normal_cxr_ct(model_pathname, src, dest, image_dir, x_col='filename', history=None, include_history=False):
+CLASSES = ['ct', 'cxr', 'nature']
+
+
+def read_new_figures(src, history=None):
+    total_df = read_table(src)
     if history is not None:
-        history_df = pd.read_csv(history)
+        history_df = read_table(history)
+        df = total_df.merge(history_df, how='outer', indicator=True).loc[lambda x: x['_merge'] == 'left_only']
+        df = df.drop('_merge', axis=1)
     else:
         history_df = pd.DataFrame()
-
-    total_df = pd.read_csv(src)
-    df = total_df.merge(history_df, how='outer', indicator=True).loc[lambda x: x['_merge'] == 'left_only']
+        df = total_df
     print('total figures', len(total_df))
     print('history figures', len(history_df))
     print('new figures', len(df))
 
     df = df.reset_index(drop=True)
-    df = df.assign(full_path=df[x_col].apply(lambda x: os.path.join(image_dir, x)))
+    return df, history_df
+
+
+class PredictionCache:
+    """
+    On-disk cache of the class scores, keyed by the content hash of the image and of the model. Images that did not
+    change are never predicted twice by the same model, and swapping the model invalidates the cache.
+    """
+
+    def __init__(self, pathname, model_pathname):
+        self.conn = sqlite3.connect(str(pathname))
+        self.conn.execute('CREATE TABLE IF NOT EXISTS predictions ('
+                          'image_hash TEXT, model_hash TEXT, ct REAL, cxr REAL, nature REAL, '
+                          'PRIMARY KEY (image_hash, model_hash))')
+        self.model_hash = file_hash(Path(model_pathname))
+
+    def get(self, image_hashes, chunk_size=500):
+        """Returns the scores of the cached images as a dict image hash -> [ct, cxr, nature]."""
+        image_hashes = list({h for h in image_hashes if h is not None})
+        scores = {}
+        for i in range(0, len(image_hashes), chunk_size):
+            chunk = image_hashes[i: i + chunk_size]
+            cursor = self.conn.execute('SELECT image_hash, ct, cxr, nature FROM predictions '
+                                       'WHERE model_hash = ? AND image_hash IN (%s)' % ','.join('?' * len(chunk)),
+                                       [self.model_hash] + chunk)
+            for image_hash, *score in cursor:
+                scores[image_hash] = score
+        return scores
+
+    def put(self, image_hashes, y_score):
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)',
+                                  [(h, self.model_hash) + tuple(float(v) for v in s)
+                                   for h, s in zip(image_hashes, y_score)])
+
+    def close(self):
+        self.conn.close()
+
+
+def detect_normal_cxr_ct(model_pathname, src, dest, image_dir, x_col='filename', history=None, include_history=False,
+                         batch_size=32):
+    df, history_df = read_new_figures(src, history)
+    store = open_store(image_dir)
+    if isinstance(store, ShardStore):
+        raise ValueError('%s has shards, which are read with detect_normal_cxr_ct_streaming' % image_dir)
+    paths = store.paths(df[x_col].astype(str))
+    store.close()
+    # the images that are not in the store are not found, as before
+    df = df.assign(full_path=[str(paths.get(x, image_dir / x)) for x in df[x_col].astype(str)])
     datagen = ImageDataGenerator(preprocessing_function=densenet.preprocess_input)
     generator = datagen.flow_from_dataframe(
         dataframe=df,
         target_size=(214, 214),
         x_col='full_path',
         class_mode=None,
-        batch_size=32,
+        batch_size=batch_size,
         shuffle=False
     )
 
@@ -49,26 +112,180 @@ def detect_normal_cxr_ct(model_pathname, src, dest, image_dir, x_col='filename',
     model = load_model(model_pathname)
     y_score = model.predict_generator(generator, verbose=1)
 
-    columns = ['ct', 'cxr', 'nature']
     y_pred = np.argmax(y_score, axis=1)
-    predictions = [columns[x] for x in y_pred]
+    predictions = [CLASSES[x] for x in y_pred]
     assert len(predictions) == len(df), '{} vs {}'.format(len(predictions), len(df))
 
-    df = df.drop(['full_path', '_merge'], axis=1)
+    df = df.drop(['full_path'], axis=1)
     df = df.assign(prediction=predictions)
     # print(history_df.columns, df.columns)
     if include_history:
         result = pd.concat([history_df, df], axis=0)
     else:
         result = df
-    result.to_csv(dest, index=False)
+    write_table(result, dest)
+
+
+def load_image(pathname, target_size=(214, 214)):
+    """
+    Loads an image as `ImageDataGenerator.flow_from_dataframe` does: RGB, resized with nearest neighbour.
+
+    Returns:
+        float32 array of [height, width, 3], None if the image cannot be read
+    """
+    if pathname is None:
+        return None
+    try:
+        with Image.open(pathname) as img:
+            return image_to_array(img, target_size)
+    except (OSError, ValueError):
+        return None
+
+
+def image_to_array(img, target_size=(214, 214)):
+    """Converts a PIL image to RGB and resizes it with nearest neighbour, as `load_image` does."""
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    if img.size != target_size:
+        img = img.resize(target_size, Image.NEAREST)
+    return np.asarray(img, dtype=np.float32)
+
+
+def load_batches(pathnames, batch_size=32, workers=4, prefetch=2, target_size=(214, 214), contents=None):
+    """
+    Loads and preprocesses images in a thread pool, up to `prefetch` batches ahead of the consumer.
+
+    Args:
+        contents: the content of each image in order, read sequentially, e.g., from `ShardStore.read`, instead of
+            opening pathnames in the thread pool
+
+    Yields:
+        indices of the images that could be read, and their densenet inputs as a float32 array of [N, 214, 214, 3]
+    """
+    with ThreadPoolExecutor(workers) as executor:
+        pending = collections.deque()
+
+        def _collect():
+            start, futures = pending.popleft()
+            images = [(start + j, f.result()) for j, f in enumerate(futures)]
+            images = [(i, image) for i, image in images if image is not None]
+            indices = [i for i, _ in images]
+            x = np.stack([image for _, image in images]) if images \
+                else np.zeros((0,) + target_size + (3,), dtype=np.float32)
+            return indices, densenet.preprocess_input(x)
+
+        for start in range(0, len(pathnames), batch_size):
+            sources = pathnames[start: start + batch_size]
+            if contents is not None:
+                sources = [io.BytesIO(next(contents)) for _ in sources]
+            futures = [executor.submit(load_image, p, target_size) for p in sources]
+            pending.append((start, futures))
+            if len(pending) > prefetch:
+                yield _collect()
+        while pending:
+            yield _collect()
+
+
+def write_predictions(dest, df, y_score, columns):
+    """Appends the rows of df with their predictions and the scores of each class to dest."""
+    y_score = np.asarray(y_score)
+    df = df.assign(prediction=[CLASSES[i] for i in np.argmax(y_score, axis=1)])
+    for j, label in enumerate(CLASSES):
+        df[label] = y_score[:, j]
+    append_table(df, dest, columns=columns)
+
+
+def detect_normal_cxr_ct_streaming(model_pathname, src, dest, image_dir, x_col='filename', history=None,
+                                   include_history=False, batch_size=32, workers=4, cache=None):
+    """
+    Same as `detect_normal_cxr_ct`, but appends the predictions and the scores of each class to dest batch by batch,
+    so memory does not grow with the number of figures. Figures already in dest, e.g., from an interrupted run, are
+    not predicted again.
+
+    With a `PredictionCache` file, images whose content was already predicted by the same model take their scores
+    from the cache, and only the others go through the model. The content hashes come from the figure store, so the
+    images are not read to look them up.
+
+    If image_dir has shards, the images are predicted in the order they are stored, and read with one sequential pass
+    over each shard.
+    """
+    df, history_df = read_new_figures(src, history)
+    columns = [c for c in df.columns if c not in ['prediction'] + CLASSES] + ['prediction'] + CLASSES
+
+    if dest.exists():
+        done = set(read_table(dest, columns=[x_col], dtype=str)[x_col].astype(str))
+        df = df[~df[x_col].astype(str).isin(done)].reset_index(drop=True)
+        print('figures already predicted in', dest.name, len(done))
+    else:
+        header = history_df.reindex(columns=columns) if include_history else pd.DataFrame(columns=columns)
+        append_table(header, dest, columns=columns)
+
+    cnt = collections.Counter()
+    store = open_store(image_dir)
+    stat = store.stat(df[x_col].astype(str))
+    names = list(df[x_col].astype(str))
+    # None for the images that are not in the store, which cannot be read
+    if isinstance(store, ShardStore):
+        pathnames = [x if x in stat else None for x in names]
+    else:
+        pathnames = [store.object_path(stat[x][1], Path(x).suffix) if x in stat else None for x in names]
+    todo = list(range(len(pathnames)))
+    if cache is not None:
+        cache = PredictionCache(cache, model_pathname)
+        hashes = [stat[x][1] if x in stat else None for x in names]
+        scores = cache.get(hashes)
+        cached = [i for i, h in enumerate(hashes) if h in scores]
+        if cached:
+            write_predictions(dest, df.iloc[cached], [scores[hashes[i]] for i in cached], columns)
+        cnt['cached'] = len(cached)
+        todo = [i for i, h in enumerate(hashes) if h not in scores]
+
+    contents = None
+    if isinstance(store, ShardStore):
+        order = {name: k for k, name in enumerate(store.storage_order(names[i] for i in todo))}
+        todo = sorted((i for i in todo if names[i] in order), key=lambda i: order[names[i]])
+        contents = (data for _, data in store.read([names[i] for i in todo]))
+
+    if todo:
+        print('Load from %s' % model_pathname)
+        model = load_model(model_pathname)
+    for indices, x in tqdm.tqdm(load_batches([pathnames[i] for i in todo], batch_size, workers, contents=contents),
+                                total=(len(todo) + batch_size - 1) // batch_size):
+        if not indices:
+            continue
+        indices = [todo[i] for i in indices]
+        y_score = np.asarray(model.predict_on_batch(x))
+        write_predictions(dest, df.iloc[indices], y_score, columns)
+        if cache is not None:
+            cache.put([hashes[i] for i in indices], y_score)
+        cnt['predicted'] += len(indices)
+
+    if cache is not None:
+        cache.close()
+    store.close()
+    cnt['cannot read'] = len(pathnames) - cnt['predicted'] - cnt['cached']
+
+    for k, v in cnt.most_common():
+        print(k, ':', v)
 
 
 if __name__ == '__main__':
     args = docopt.docopt(__doc__)
-    detect_normal_cxr_ct(src=Path(args['-i']),
-                         dest=Path(args['-o']),
-                         image_dir=Path(args['-f']),
-                         x_col='subfigure filename',
-                         history=Path(args['-l']),
-                         model_pathname=Path(args['-m']))
+    if args['--stream']:
+        detect_normal_cxr_ct_streaming(src=Path(args['-i']),
+                                       dest=Path(args['-o']),
+                                       image_dir=Path(args['-f']),
+                                       x_col='subfigure filename',
+                                       history=Path(args['-l']) if args['-l'] else None,
+                                       model_pathname=Path(args['-m']),
+                                       batch_size=int(args['--batch-size']),
+                                       workers=int(args['--workers']),
+                                       cache=args['--cache'])
+    else:
+        detect_normal_cxr_ct(src=Path(args['-i']),
+                             dest=Path(args['-o']),
+                             image_dir=Path(args['-f']),
+                             x_col='subfigure filename',
+                             history=Path(args['-l']) if args['-l'] else None,
+                             model_pathname=Path(args['-m']),
+                             batch_size=int(args['--batch-size']))
@@ -15,11 +15,22 @@ from pathlib import Path
 
 import docopt
 import pandas as pd
-import tqdm
+
+from figurex.utils import read_table, write_table
+
+
+def label_subfigures(df, gs, time):
+    """
+    Args:
+        df: sub-figure table
+        gs: sub-figure file name -> gold label. Sub-figures not in gs are labeled nature.
+        time: insert time of the sub-figures
+    """
+    return df.assign(label=df['subfigure filename'].map(gs).fillna('nature'), insert_time=time)
 
 
 def collect_gold_standard(src, dst, gold_dir, previous_gold):
-    previous_gold_df = pd.read_csv(previous_gold, dtype=str)
+    previous_gold_df = read_table(previous_gold, dtype=str)
     subfigure_filenames = set(previous_gold_df['subfigure filename'])
 
     gs = {}
@@ -28,31 +39,20 @@ def collect_gold_standard(src, dst, gold_dir, previous_gold):
             for entry in it:
                 gs[entry.name] = label
 
-    cnt = collections.Counter()
-    df = pd.read_csv(src, dtype=str)
+    df = read_table(src, dtype=str)
     df = df.drop('prediction', axis=1)
 
     time = src.name[:src.name.find('.')]
-    data = []
-    for _, row in tqdm.tqdm(df.iterrows(), total=len(df)):
-        subfig = row['subfigure filename']
-        if subfig in gs:
-            label = gs[subfig]
-        else:
-            label = 'nature'
-            cnt['skip'] += 1
-
-        row['label'] = label
-        row['insert_time'] = time
-
-        if subfig in subfigure_filenames:
-            cnt['Duplicate'] += 1
-        data.append(row)
-
-    df = pd.DataFrame(data)
+    df = label_subfigures(df, gs, time)
+    # unary plus drops the counts that are zero
+    cnt = +collections.Counter({
+        'skip': int((~df['subfigure filename'].isin(set(gs))).sum()),
+        'Duplicate': int(df['subfigure filename'].isin(subfigure_filenames).sum()),
+    })
+
     df = df.drop_duplicates()
     df = pd.concat([previous_gold_df, df], axis=0)
-    df.to_csv(dst, index=False)
+    write_table(df, dst)
 
     for k, v in cnt.most_common():
         print(k, v)
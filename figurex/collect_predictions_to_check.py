@@ -5,21 +5,41 @@ Usage:
 Options:
     -i <file>       Prediction csv file
     -o <dir>        Output dir
-    -f <dir>        figure dir
+    -f <dir>        subfigure store or shard dir
     -l <file>       history csv file
 """
 
 import collections
-import shutil
+import os
 from pathlib import Path
 
 import docopt
-import pandas as pd
 import tqdm
 
+from figurex.figure_store import open_store
+from figurex.utils import read_table
+
+
+def images_to_copy(df, gs, skip_gold=True):
+    """
+    Args:
+        df: prediction table
+        gs: sub-figure file name -> gold label, which replaces the prediction
+        skip_gold: skip the sub-figures in gs instead
+
+    Returns:
+        DataFrame: the sub-figures predicted or labeled ct or cxr, with their "subfigure filename" and "prediction"
+    """
+    in_gold = df['subfigure filename'].isin(set(gs))
+    if skip_gold:
+        df = df[~in_gold]
+    else:
+        df = df.assign(prediction=df['subfigure filename'].map(gs).where(in_gold, df['prediction']))
+    return df.loc[df['prediction'].isin(['cxr', 'ct']), ['subfigure filename', 'prediction']]
+
 
 def collect_cxr_ct(src, src_image_dir, dst_image_dir, gold_file=None, skip_gold=True):
-    df = pd.read_csv(src)
+    df = read_table(src, columns=['subfigure filename', 'prediction'])
     subdf = df[df['prediction'].isin(('cxr', 'ct'))].reset_index(drop=True)
     # subdf.to_csv(dst, index=None)
     print(len(df), len(subdf))
@@ -35,32 +55,32 @@ def collect_cxr_ct(src, src_image_dir, dst_image_dir, gold_file=None, skip_gold=
 
     gs = {}
     if gold_file is not None:
-        gold_df = pd.read_csv(gold_file)
-        for i, row in gold_df.iterrows():
-            gs[row['subfigure filename']] = row['label']
-
-    for _, row in tqdm.tqdm(df.iterrows(), total=len(df)):
-        subfig = row['subfigure filename']
-        src_img = src_image_dir / subfig
-        if subfig in gs:
-            if skip_gold:
-                continue
-            prediction = gs[subfig]
+        gold_df = read_table(gold_file, columns=['subfigure filename', 'label'])
+        gs = dict(zip(gold_df['subfigure filename'], gold_df['label']))
+
+    todo = images_to_copy(df, gs, skip_gold)
+    # the images to check keep their names, so that they can be moved between the label folders
+    existing = {label: set(os.listdir(dst_image_dir / label)) for label in ['ct', 'cxr', 'nature']}
+    labels = collections.defaultdict(list)
+    for subfig, prediction in zip(todo['subfigure filename'], todo['prediction']):
+        if subfig in existing[prediction]:
+            cnt['skip'] += 1
         else:
-            prediction = row['prediction']
-
-        if prediction in ['cxr', 'ct']:
-            dst_img = dst_image_dir / prediction / subfig
-            if dst_img.exists():
-                cnt['skip'] += 1
-                continue
-            try:
-                shutil.copy(src_img, dst_img)
-                cnt['copy'] += 1
-            except:
-                cnt['Cannot found'] += 1
-                print('Cannot find', src_img)
-                exit(1)
+            labels[subfig].append(prediction)
+
+    store = open_store(src_image_dir)
+    stored = store.stat(labels)
+    for subfig in labels:
+        if subfig not in stored:
+            print('Cannot find', subfig, 'in', src_image_dir)
+            exit(1)
+    # in the order of the store, i.e., sequential reads of the shards
+    for subfig, data in tqdm.tqdm(store.read(store.storage_order(labels)), total=len(labels)):
+        for prediction in labels[subfig]:
+            with open(dst_image_dir / prediction / subfig, 'wb') as fp:
+                fp.write(data)
+            cnt['copy'] += 1
+    store.close()
 
     # # whole figure
     # src_image_dir = top / 'figures'
@@ -4,8 +4,13 @@ FigureSeparator class
 
 Modified by: Yifan Peng
 """
+import io
 import math
+import queue
 import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import numpy as np
@@ -15,10 +20,20 @@ from PIL import Image
 
 
 class FigureSeparator:
-    def __init__(self, model, thresh=0.5):
+    def __init__(self, model, thresh=0.5, vectorized=True):
+        """
+        Args:
+            model: path to the frozen graph
+            thresh: confidence threshold of a sub-figure
+            vectorized: decode the network output with the array-based `postprocess_vectorized` (and
+                `postprocess_batch` in `extract_batch`) instead of the box-by-box `postprocess`. Both return the same
+                sub-figures.
+        """
         self.meta = {'object_scale': 5, 'classes': 1, 'out_size': [17, 17, 30], 'colors': [(0, 0, 254)],
                      'thresh': thresh, 'anchors': [1.08, 1.19, 3.42, 4.41, 6.63, 11.38, 9.42, 5.11, 16.62, 10.52],
                      'num': 5, 'labels': ['figure']}
+        self.vectorized = vectorized
+        self.postprocess = postprocess_vectorized if vectorized else postprocess
         self.graph = load_graph(model)
 
     def extract(self, img_path):
@@ -45,30 +60,181 @@ class FigureSeparator:
         """
         imgcv, imgcv_resized, img_input = preprocess(str(img_path))
         detections = sess.run('output:0', feed_dict={'input:0': img_input})
-        sub_figures, annotated_image = postprocess(self.meta, detections, imgcv)
+        sub_figures, annotated_image = self.postprocess(self.meta, detections, imgcv)
         return sub_figures, annotated_image
 
-    def extract_batch(self, sess, img_paths):
-        batch = []
-        for img_path in img_paths:
-            imgcv, imgcv_resized, img_input = preprocess(str(img_path))
-            batch.append({'imgcv': imgcv, 'imgcv_resized': imgcv_resized, 'img_input': img_input[0]})
-        inputs = [x['img_input'] for x in batch]
+    def extract_batch(self, sess, img_paths, lean=False, annotate=False):
+        """
+        Args:
+            sess: tensorflow Session
+            img_paths: file paths to the image files
+            lean: only keep the (height, width) of each image in the results, not the image arrays
+            annotate: draw the sub-figures on the original images
+
+        Returns:
+            List: a dict per image with "shape" and "sub_figures" (see `extract_sess`). Unless lean, also the image
+            arrays "imgcv", "imgcv_resized" and "annotated_image"; "annotated_image" is always there if annotate.
+        """
+        batch, inputs = load_batch(img_paths, keep_images=not lean or annotate, keep_resized=not lean)
+        batch = self.extract_loaded(sess, batch, inputs, annotate)
+        if lean:
+            for x in batch:
+                x.pop('imgcv', None)
+                x.pop('imgcv_resized', None)
+        return batch
+
+    def extract_loaded(self, sess, batch, inputs, annotate=False):
+        """
+        Same as `extract_batch`, for a batch already loaded by `load_batch` or `BatchLoader`. Annotation requires the
+        batch to keep the images.
+        """
         detections_batch = sess.run('output:0', feed_dict={'input:0': inputs})
 
-        for j, detections in enumerate(detections_batch):
-            imgcv = batch[j]['imgcv']
+        if self.vectorized and not annotate:
+            shapes = [x['shape'] for x in batch]
+            for x, sub_figures in zip(batch, postprocess_batch(self.meta, detections_batch, shapes)):
+                x['sub_figures'] = sub_figures
+                if 'imgcv' in x:
+                    x['annotated_image'] = x['imgcv']
+            return batch
+
+        for x, detections in zip(batch, detections_batch):
+            imgcv = x.get('imgcv')
+            if imgcv is None and x['shape'] is not None:
+                # postprocess only needs the shape of the image unless annotating
+                imgcv = np.empty(x['shape'] + (0,), dtype=np.uint8)
             detections = np.expand_dims(detections, axis=0)
             try:
-                sub_figures, annotated_image = postprocess(self.meta, detections, imgcv)
-                batch[j]['sub_figures'] = sub_figures
-                batch[j]['annotated_image'] = annotated_image
+                sub_figures, annotated_image = self.postprocess(self.meta, detections, imgcv, annotate)
+                x['sub_figures'] = sub_figures
+                if 'imgcv' in x or annotate:
+                    x['annotated_image'] = annotated_image
             except:
-                batch[j]['sub_figures'] = []
-                batch[j]['annotated_image'] = None
+                x['sub_figures'] = []
+                if 'imgcv' in x or annotate:
+                    x['annotated_image'] = None
         return batch
 
 
+def load_batch(img_paths, executor=None, w=544, h=544, keep_images=True, keep_resized=False, inputs=None,
+               reduced=False):
+    """
+    Preprocesses a batch of images with `preprocess_into`, in parallel if an executor is given.
+
+    Args:
+        img_paths: file paths to the images, or the encoded image bytes
+        executor: optional executor to preprocess the images in parallel
+        keep_images: keep the original images, otherwise only their (height, width)
+        keep_resized: keep the resized images too
+        inputs: optional float32 array of [N, h, w, 3] to write the network input into
+        reduced: decode JPEG images at a reduced resolution, see `preprocess_into`. The original images are not
+            decoded, so they cannot be kept.
+
+    Returns:
+        List: a dict per image with the "shape" of the original image (None if it cannot be read), and the
+            "imgcv" and "imgcv_resized" image arrays if kept
+        float32 array of [N, h, w, 3]: the network input. Images that cannot be read are left black.
+    """
+    if keep_images and reduced:
+        raise ValueError('the original images are not decoded with reduced')
+    if inputs is None:
+        inputs = np.empty((len(img_paths), h, w, 3), dtype=np.float32)
+
+    def _load(j):
+        imgcv, imgcv_resized, shape = preprocess_into(img_paths[j], inputs[j], keep_images and keep_resized, reduced)
+        x = {'shape': shape}
+        if keep_images:
+            x['imgcv'] = imgcv
+            if keep_resized:
+                x['imgcv_resized'] = imgcv_resized
+        return x
+
+    batch = list(executor.map(_load, range(len(img_paths))) if executor is not None
+                 else map(_load, range(len(img_paths))))
+    return batch, inputs
+
+
+class BatchLoader:
+    """
+    Loads batches of images in a thread pool ahead of the inference, so that decoding batch k+1 overlaps the inference
+    of batch k. cv2 releases the GIL while decoding and resizing, so threads are enough.
+
+    Iterating over the loader yields (img_paths, batch, inputs, decode time) for each batch, where batch and inputs are
+    returned by `load_batch`. The inputs are written into a small pool of preallocated buffers, so an inputs array is
+    only valid until the next batch is requested.
+    """
+
+    def __init__(self, img_paths, batch_size=64, workers=4, queue_size=2, w=544, h=544, keep_images=True,
+                 keep_resized=False, reduced=False):
+        """
+        Args:
+            img_paths: images to load
+            batch_size: number of images per batch
+            workers: number of decoding threads
+            queue_size: maximum number of batches loaded ahead
+            keep_images: keep the original images, otherwise only their (height, width)
+            keep_resized: keep the resized images too
+            reduced: decode JPEG images at a reduced resolution, without keep_images
+        """
+        self.img_paths = list(img_paths)
+        self.batch_size = batch_size
+        self.workers = workers
+        self.queue_size = queue_size
+        self.w, self.h = w, h
+        self.keep_images = keep_images
+        self.keep_resized = keep_resized
+        self.reduced = reduced
+
+    def __len__(self):
+        return math.ceil(len(self.img_paths) / self.batch_size)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def produce():
+            # one buffer for the batch being loaded, the queued ones, and the one in use by the consumer
+            buffers = [None] * (self.queue_size + 2)
+            try:
+                with ThreadPoolExecutor(self.workers) as executor:
+                    for k, i in enumerate(range(0, len(self.img_paths), self.batch_size)):
+                        img_paths = self.img_paths[i: i + self.batch_size]
+                        start = time.perf_counter()
+                        if buffers[k % len(buffers)] is None:
+                            buffers[k % len(buffers)] = np.empty((self.batch_size, self.h, self.w, 3), dtype=np.float32)
+                        batch, inputs = load_batch(img_paths, executor, self.w, self.h, self.keep_images,
+                                                   self.keep_resized, buffers[k % len(buffers)][:len(img_paths)],
+                                                   self.reduced)
+                        put((img_paths, batch, inputs, time.perf_counter() - start))
+                        if stop.is_set():
+                            return
+            except Exception as e:
+                put(e)
+            put(None)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            producer.join()
+
+
 """
 Citation:
 This is taken from the darkflow repository
@@ -231,17 +397,285 @@ def postprocess(meta, net_out, imgcv, annotate=False):
     return outboxes, imgcv
 
 
+def decode(meta, net_out):
+    """
+    Array-based version of the box decoding in `postprocess`.
+
+    The arithmetic follows `postprocess` step by step (including its float64 promotion of the scalar values), so that
+    both functions produce the same numbers.
+
+    Args:
+        meta: meta data
+        net_out: output from the CNN, with shape [..., H, W, B * (5 + C)]
+
+    Returns:
+        x, y, w, h: box centers and sizes relative to the image, with shape [..., H * W * B]
+        probs: class probabilities after thresholding, with shape [..., H * W * B, C]
+    """
+    H, W, _ = meta['out_size']
+    threshold = meta['thresh']
+    B = meta['num']
+    anchors = np.asarray(meta['anchors'], dtype=np.float64).reshape([B, 2])
+    net_out = net_out.reshape(net_out.shape[:-3] + (H, W, B, -1))
+
+    def _expit64(v):
+        return 1. / (1. + np.exp(-v).astype(np.float64))
+
+    c = _expit64(net_out[..., 4])
+    cols = np.arange(W, dtype=np.float64).reshape([1, W, 1])
+    rows = np.arange(H, dtype=np.float64).reshape([H, 1, 1])
+    x = (cols + _expit64(net_out[..., 0])) / W
+    y = (rows + _expit64(net_out[..., 1])) / H
+    w = np.exp(net_out[..., 2].astype(np.float64)) * anchors[:, 0] / W
+    h = np.exp(net_out[..., 3].astype(np.float64)) * anchors[:, 1] / H
+
+    classes = net_out[..., 5:]
+    e_x = np.exp(classes - np.max(classes, axis=-1, keepdims=True))
+    probs = e_x / e_x.sum(axis=-1, keepdims=True)
+    probs = probs * c[..., None].astype(probs.dtype)
+    probs *= probs > threshold
+
+    shape = net_out.shape[:-4] + (H * W * B,)
+    return x.reshape(shape), y.reshape(shape), w.reshape(shape), h.reshape(shape), probs.reshape(shape + (-1,))
+
+
+def iou_matrix(x, y, w, h):
+    """Pairwise `box_iou` of the boxes (x, y, w, h) along the last axis."""
+
+    def _overlap(c, s):
+        left = np.maximum((c - s / 2.)[..., :, None], (c - s / 2.)[..., None, :])
+        right = np.minimum((c + s / 2.)[..., :, None], (c + s / 2.)[..., None, :])
+        return right - left
+
+    ow = _overlap(x, w)
+    oh = _overlap(y, h)
+    intersection = np.where((ow < 0) | (oh < 0), 0., ow * oh)
+    area = w * h
+    union = area[..., :, None] + area[..., None, :] - intersection
+    return intersection / union
+
+
+# candidate pairs of the images suppressed together, as the IoU of a group takes several [N, K, K] float64 arrays
+MAX_NMS_PAIRS = 1 << 21
+
+
+def nms(x, y, w, h, probs, max_pairs=MAX_NMS_PAIRS):
+    """
+    Non max suppression of `postprocess` for a batch of images.
+
+    Only boxes with a non-zero probability take part: the others can neither suppress a box nor be reported. The
+    images are suppressed in groups of similar candidate counts, padded to the largest count of their group, so that
+    a group has at most max_pairs candidate pairs, unless a single image has more.
+
+    Args:
+        x, y, w, h: boxes, with shape [N, M]
+        probs: class probabilities, with shape [N, M, C]
+
+    Returns:
+        order: indices of the candidates of each image in the order `postprocess` reports them, with shape [N, K]
+        valid: False for the padding in order
+        probs: probabilities after suppression
+    """
+    counts = probs.any(axis=-1).sum(axis=1)
+    n, k = len(probs), counts.max(initial=0)
+    order = np.zeros((n, k), dtype=np.intp)
+    valid = np.zeros((n, k), dtype=bool)
+    probs = probs.copy()
+
+    groups, group = [], []
+    for j in np.argsort(counts, kind='stable'):
+        # the counts are increasing, so the image is the largest of its group
+        if group and (len(group) + 1) * int(counts[j]) ** 2 > max_pairs:
+            groups.append(group)
+            group = []
+        group.append(j)
+    groups.append(group)
+
+    for group in groups:
+        group = np.array(group, dtype=np.intp)
+        group_order, group_valid, probs[group] = _nms_padded(x[group], y[group], w[group], h[group], probs[group])
+        order[group, :group_order.shape[1]] = group_order
+        valid[group, :group_valid.shape[1]] = group_valid
+    return order, valid, probs
+
+
+def _nms_padded(x, y, w, h, probs):
+    """`nms` of images whose candidates are all padded to the same length K, so that they are suppressed together."""
+    probs = probs.copy()
+    candidates = probs.any(axis=-1)
+    counts = candidates.sum(axis=1)
+    n, k = len(probs), counts.max(initial=0)
+    valid = np.arange(k) < counts[:, None]
+    order = np.zeros((n, k), dtype=np.intp)
+    order[valid] = np.nonzero(candidates)[1]
+    if k == 0:
+        return order, valid, probs
+
+    rows = np.broadcast_to(np.arange(n)[:, None], (n, k))
+    iou = iou_matrix(*(np.take_along_axis(a, order, axis=1) for a in (x, y, w, h)))
+    pos = np.broadcast_to(np.arange(k), (n, k))
+    for c in range(probs.shape[-1]):
+        # sorted(..., reverse=True) is stable, so is the argsort on the negated probabilities
+        p = np.where(valid, probs[rows, order, c], 0.)
+        perm = np.argsort(-p, axis=1, kind='stable')
+        order, valid, pos, p = (np.take_along_axis(a, perm, axis=1) for a in (order, valid, pos, p))
+        keep = p != 0
+        suppressed = iou[rows[:, :, None], pos[:, :, None], pos[:, None, :]] >= .4
+        for i in range(k):
+            keep[:, i + 1:] &= ~(suppressed[:, i, i + 1:] & keep[:, i, None])
+        drop = valid & ~keep
+        probs[rows[drop], order[drop], c] = 0.
+    return order, valid, probs
+
+
+def _select_boxes(meta, net_out, shapes):
+    """
+    Decodes and suppresses the boxes of a batch of images.
+
+    Returns:
+        List: for each image, the (left, top, right, bot, class index, probability) of the reported boxes
+    """
+    H, W, _ = meta['out_size']
+    threshold = meta['thresh']
+    x, y, w, h, probs = decode(meta, net_out.reshape([-1, H, W, net_out.shape[-1]]))
+    order, valid, probs = nms(x, y, w, h, probs)
+
+    rows = np.arange(len(order))[:, None]
+    probs = probs[rows, order]
+    max_indx = np.argmax(probs, axis=-1)
+    max_prob = np.take_along_axis(probs, max_indx[..., None], axis=-1)[..., 0]
+    x, y, w, h = (a[rows, order] for a in (x, y, w, h))
+    img_h = np.array([s[0] if s is not None else 0 for s in shapes])[:, None]
+    img_w = np.array([s[1] if s is not None else 0 for s in shapes])[:, None]
+    # np.rint rounds half to even, as round() does
+    left = np.maximum(np.rint((x - w / 2.) * img_w), 0).astype(int)
+    right = np.minimum(np.rint((x + w / 2.) * img_w), img_w - 1).astype(int)
+    top = np.maximum(np.rint((y - h / 2.) * img_h), 0).astype(int)
+    bot = np.minimum(np.rint((y + h / 2.) * img_h), img_h - 1).astype(int)
+    reported = valid & (max_prob > threshold) & (img_h > 0)
+    return [list(zip(*(a[j][reported[j]] for a in (left, top, right, bot, max_indx, max_prob))))
+            for j in range(len(order))]
+
+
+def _to_outbox(left, top, right, bot):
+    return {"x": int(left), "y": int(top), "w": int(right - left), "h": int(bot - top)}
+
+
+def postprocess_batch(meta, net_out, shapes):
+    """
+    Same as `postprocess` for a batch of images, but decodes and suppresses the boxes of all images at once.
+
+    Args:
+        meta: meta data
+        net_out: output from the CNN, with shape [N, H, W, B * (5 + C)]
+        shapes: (height, width) of the original images, None for an image that cannot be read
+
+    Returns:
+        List: the sub-figures of each image
+    """
+    return [[dict(_to_outbox(left, top, right, bot), conf=float(prob))
+             for left, top, right, bot, _, prob in boxes]
+            for boxes in _select_boxes(meta, net_out, shapes)]
+
+
+def postprocess_vectorized(meta, net_out, imgcv, annotate=False):
+    """
+    Same as `postprocess`, but decodes all boxes at once and only runs non max suppression on the boxes above the
+    threshold.
+
+    Args:
+        meta: meta data
+        net_out:output from the CNN
+        imgcv: original image array
+        annotate: annotate bounding box to the image or not
+    """
+    colors = meta['colors']
+    h, w, _ = imgcv.shape
+
+    outboxes = []
+    for left, top, right, bot, max_indx, max_prob in _select_boxes(meta, net_out, [(h, w)])[0]:
+        outboxes.append(dict(_to_outbox(left, top, right, bot), conf=float(max_prob)))
+
+        if annotate:
+            thick = int((h + w) / 300)
+            mess = '%03.3f' % max_prob
+            cv2.rectangle(imgcv, (left, top), (right, bot), colors[max_indx], thick)
+            cv2.putText(imgcv, mess, (left + thick * 4, top + thick * 6), 0, 1e-3 * h, colors[max_indx], thick // 3)
+
+    return outboxes, imgcv
+
+
+# pixel value / 255. as the float32 the network receives
+_SCALE = (np.arange(256) / 255.).astype(np.float32)
+
+
+# cv2 flags to decode a JPEG image at 1/8, 1/4 or 1/2 of its size, with the DCT scaling of libjpeg
+_REDUCED_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)]
+# EXIF orientations that swap the width and the height, which cv2 applies when decoding
+_TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+def reduced_flag(img_path, w=544, h=544):
+    """
+    Reads the header of a JPEG image to decode it at the smallest scale that is still at least w x h.
+
+    Returns:
+        the cv2 imread flag, IMREAD_COLOR if the image is not a JPEG or too small to be reduced
+        (height, width) of the image at full resolution, as cv2 decodes it, None if the image is not a JPEG
+    """
+    try:
+        with Image.open(io.BytesIO(img_path) if isinstance(img_path, bytes) else img_path) as img:
+            if img.format != 'JPEG':
+                return cv2.IMREAD_COLOR, None
+            width, height = img.size
+            if img.getexif().get(0x0112) in _TRANSPOSED_ORIENTATIONS:
+                width, height = height, width
+    except (OSError, ValueError):
+        return cv2.IMREAD_COLOR, None
+    for scale, flag in _REDUCED_FLAGS:
+        if width // scale >= w and height // scale >= h:
+            return flag, (height, width)
+    return cv2.IMREAD_COLOR, (height, width)
+
+
 def preprocess(img_path, w=544, h=544):
-    imgcv = cv2.imread(img_path)
+    img_input = np.empty((1, h, w, 3), dtype=np.float32)
+    imgcv, imgcv_resized, _ = preprocess_into(img_path, img_input[0], keep_resized=True)
     if imgcv is None:
         return None, None, None
-    imgcv_resized = cv2.resize(imgcv, (w, h))
-    img_input = imgcv_resized / 255.
-    img_input = img_input[:, :, ::-1]
-    img_input = np.expand_dims(img_input, axis=0)
     return imgcv, imgcv_resized, img_input
 
 
+def preprocess_into(img_path, out, keep_resized=False, reduced=False):
+    """
+    Reads and resizes an image, and writes the scaled RGB network input into `out` in one pass.
+
+    Args:
+        img_path: file path to the image file, or the encoded image bytes
+        out: float32 array of [h, w, 3]. Left black if the image cannot be read.
+        keep_resized: return the resized image, otherwise it is dropped once the input is written
+        reduced: decode a JPEG image larger than out at a reduced resolution, as the network only needs the resized
+            image. The returned image is then the reduced one.
+
+    Returns:
+        original image array, None if the image cannot be read
+        resized image array, None unless keep_resized
+        (height, width) of the original image, None if the image cannot be read
+    """
+    h, w, _ = out.shape
+    flag, shape = reduced_flag(img_path, w, h) if reduced else (cv2.IMREAD_COLOR, None)
+    if isinstance(img_path, bytes):
+        imgcv = cv2.imdecode(np.frombuffer(img_path, dtype=np.uint8), flag)
+    else:
+        imgcv = cv2.imread(str(img_path), flag)
+    if imgcv is None:
+        out[...] = 0
+        return None, None, None
+    imgcv_resized = cv2.resize(imgcv, (w, h))
+    np.take(_SCALE, imgcv_resized[:, :, ::-1], out=out)
+    return imgcv, imgcv_resized if keep_resized else None, shape if shape is not None else imgcv.shape[:2]
+
+
 def load_graph(frozen_graph_filename):
     # citation: figure_separator is taken from
     # https://blog.metaflow.fr/tensorflow-how-to-freeze-a-model-and-serve-it-with-a-python-api-d4f3596b3adc#.137byfk9k
@@ -0,0 +1,376 @@
+"""
+Migrates a flat folder of figures or sub-figures into a figure store, packs a figure store into tar shards, or removes
+the objects of a store that no name refers to anymore.
+
+Usage:
+    script.py migrate [options] -i FLAT_DIR -o STORE_DIR
+    script.py pack [options] -i STORE_DIR -o SHARD_DIR
+    script.py prune STORE_DIR
+
+Options:
+    -i <dir>        Flat figure folder, or figure store folder to pack
+    -o <dir>        Figure store folder, which can be FLAT_DIR itself, or shard folder
+    --move          Move the files into the store instead of copying them
+    --shard-size <int>  Size of each shard in MB [default: 1024]
+"""
+
+import collections
+import contextlib
+import hashlib
+import io
+import os
+import shutil
+import sqlite3
+import tarfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+
+import docopt
+import tqdm
+
+from figurex.utils import file_hash
+
+STORE_FILE = '.store.db'
+OBJECTS_DIR = 'objects'
+SHARD_INDEX = '.shards.db'
+SHARD_FILE = 'shard-%06d.tar'
+
+
+class FigureStore:
+    """
+    Figures and sub-figures by name, e.g., "PMC1_fig1.jpg" or "PMC1_fig1_0x0_300x200.jpg". Each content is stored once,
+    as objects/ab/cd/abcd...jpg after its SHA-1, so that no folder grows with the number of figures and a figure that
+    appears in several articles is stored once. The name of each figure is mapped to its SHA-1 in a SQLite table, so
+    the stages resolve names to paths with lookups instead of checking files.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        (self.root / OBJECTS_DIR).mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.root / STORE_FILE), timeout=60, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            with self.conn:
+                self.conn.execute('CREATE TABLE IF NOT EXISTS names (name TEXT PRIMARY KEY, hash TEXT, size INTEGER)')
+                self.conn.execute('CREATE INDEX IF NOT EXISTS names_hash ON names (hash)')
+
+    def close(self):
+        self.conn.close()
+
+    def __contains__(self, name):
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM names WHERE name = ?', (name,)).fetchone() is not None
+
+    def object_path(self, sha1, suffix=''):
+        return self.root / OBJECTS_DIR / sha1[:2] / sha1[2:4] / f'{sha1}{suffix}'
+
+    def path(self, name) -> Path:
+        """Raises KeyError if the name is not in the store."""
+        with self.lock:
+            row = self.conn.execute('SELECT hash FROM names WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return self.object_path(row[0], Path(name).suffix)
+
+    def stat(self, names=None) -> Dict[str, Tuple[int, str]]:
+        """
+        Returns:
+            Dict: name -> (size, SHA-1), for the names in the store, or for all names
+        """
+        with self.lock:
+            rows = self.conn.execute('SELECT name, size, hash FROM names').fetchall()
+        if names is not None:
+            names = set(names)
+            rows = [row for row in rows if row[0] in names]
+        return {name: (size, sha1) for name, size, sha1 in rows}
+
+    def paths(self, names) -> Dict[str, Path]:
+        """Paths of the names in the store, in one query."""
+        return {name: self.object_path(sha1, Path(name).suffix) for name, (_, sha1) in self.stat(names).items()}
+
+    def storage_order(self, names) -> List[str]:
+        """The names in the store, in the order `read` reads them fastest, which is any order for files."""
+        stored = self.stat(names)
+        return [name for name in dict.fromkeys(names) if name in stored]
+
+    def read(self, names) -> Iterator[Tuple[str, bytes]]:
+        """Yields the name and content of each name in the store, in order."""
+        for name, path in self.paths(names).items():
+            with open(path, 'rb') as fp:
+                yield name, fp.read()
+
+    def _register(self, name, sha1, size):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO names VALUES (?, ?, ?)', (name, sha1, size))
+
+    def _commit(self, name, tmp, sha1, size):
+        dst = self.object_path(sha1, Path(name).suffix)
+        if dst.exists():
+            # the same content under another name
+            os.remove(tmp)
+        else:
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp, dst)
+        self._register(name, sha1, size)
+        return dst
+
+    @contextlib.contextmanager
+    def writer(self, name):
+        """
+        Writes the content of a name to a temporary file, and stores it only if the block completes.
+
+        Yields:
+            a binary file, whose "path", "sha1" and "size" are set after the block
+        """
+        tmp = self.root / OBJECTS_DIR / ('.%s.%d.%d.tmp' % (name, os.getpid(), threading.get_ident()))
+        try:
+            with open(tmp, 'wb') as raw:
+                fp = _ObjectFile(raw)
+                yield fp
+            # hashed once written, as writers such as PIL may seek or write to the file descriptor
+            fp.sha1 = file_hash(tmp)
+            fp.size = os.stat(tmp).st_size
+            fp.path = self._commit(name, tmp, fp.sha1, fp.size)
+        except BaseException:
+            if tmp.exists():
+                os.remove(tmp)
+            raise
+
+    def put_file(self, name, pathname, sha1=None) -> Path:
+        """Stores a file under name. Given its SHA-1, a content that is already stored is not read again."""
+        if sha1 is not None:
+            dst = self.object_path(sha1, Path(name).suffix)
+            if dst.exists():
+                self._register(name, sha1, dst.stat().st_size)
+                return dst
+        with self.writer(name) as fp, open(pathname, 'rb') as src:
+            shutil.copyfileobj(src, fp, 1 << 20)
+        return fp.path
+
+    def prune(self):
+        """Removes the objects that no name refers to, and the temporary files of interrupted writes."""
+        with self.lock:
+            used = {sha1 for (sha1,) in self.conn.execute('SELECT DISTINCT hash FROM names')}
+        cnt = collections.Counter()
+        for dirpath, _, filenames in os.walk(self.root / OBJECTS_DIR):
+            for filename in filenames:
+                if filename.startswith('.') or filename.split('.', 1)[0] not in used:
+                    os.remove(os.path.join(dirpath, filename))
+                    cnt['pruned'] += 1
+                else:
+                    cnt['object'] += 1
+        return cnt
+
+
+class ShardStore:
+    """
+    Same names and contents as a `FigureStore`, packed in tar shards of about shard_size bytes, each content once as
+    <sha1><suffix>, so that reading many small images is a few sequential reads. The shards are plain tar files that
+    tar and WebDataset can read, and the offset of each content is in a SQLite index, SHARD_INDEX.
+
+    A shard is never appended to once closed, and each run writes a new shard, so an interrupted run leaves at most a
+    truncated last shard, whose indexed contents are complete.
+    """
+
+    def __init__(self, root, shard_size=1 << 30):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.shard_size = shard_size
+        self.conn = sqlite3.connect(str(self.root / SHARD_INDEX), timeout=60, check_same_thread=False)
+        self.lock = threading.Lock()
+        self._tar = None
+        self._shard = None
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            with self.conn:
+                self.conn.execute('CREATE TABLE IF NOT EXISTS names (name TEXT PRIMARY KEY, hash TEXT, size INTEGER)')
+                self.conn.execute('CREATE TABLE IF NOT EXISTS objects (hash TEXT PRIMARY KEY, shard TEXT, '
+                                  'offset INTEGER, size INTEGER)')
+
+    def close(self):
+        with self.lock:
+            self._close_shard()
+        self.conn.close()
+
+    def __contains__(self, name):
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM names WHERE name = ?', (name,)).fetchone() is not None
+
+    def stat(self, names=None) -> Dict[str, Tuple[int, str]]:
+        """Same as `FigureStore.stat`."""
+        with self.lock:
+            rows = self.conn.execute('SELECT name, size, hash FROM names').fetchall()
+        if names is not None:
+            names = set(names)
+            rows = [row for row in rows if row[0] in names]
+        return {name: (size, sha1) for name, size, sha1 in rows}
+
+    def _locations(self, names) -> Dict[str, Tuple[str, int, int]]:
+        """name -> (shard, offset, size) of the names in the store"""
+        with self.lock:
+            rows = self.conn.execute('SELECT names.name, objects.shard, objects.offset, objects.size FROM names '
+                                     'JOIN objects ON names.hash = objects.hash').fetchall()
+        names = set(names)
+        return {name: (shard, offset, size) for name, shard, offset, size in rows if name in names}
+
+    def storage_order(self, names) -> List[str]:
+        """The names in the store, sorted by shard and offset, so that `read` goes through each shard once."""
+        locations = self._locations(names)
+        return sorted(locations, key=lambda name: locations[name][:2])
+
+    def read(self, names) -> Iterator[Tuple[str, bytes]]:
+        """
+        Yields the name and content of each name in the store, in order. Names in `storage_order` are read with one
+        sequential pass over each shard.
+        """
+        names = list(names)
+        locations = self._locations(names)
+        with self.lock:
+            if self._tar is not None:
+                self._tar.fileobj.flush()
+        fp, current = None, None
+        try:
+            for name in names:
+                if name not in locations:
+                    continue
+                shard, offset, size = locations[name]
+                if shard != current:
+                    if fp is not None:
+                        fp.close()
+                    fp, current = open(self.root / shard, 'rb'), shard
+                if fp.tell() != offset:
+                    fp.seek(offset)
+                yield name, fp.read(size)
+        finally:
+            if fp is not None:
+                fp.close()
+
+    def _close_shard(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar, self._shard = None, None
+
+    def _open_shard(self):
+        with os.scandir(self.root) as it:
+            numbers = [int(e.name[6:-4]) for e in it if e.name.startswith('shard-') and e.name.endswith('.tar')]
+        self._shard = SHARD_FILE % (max(numbers, default=-1) + 1)
+        self._tar = tarfile.open(self.root / self._shard, 'w', format=tarfile.USTAR_FORMAT)
+
+    def put_bytes(self, name, data, sha1=None):
+        sha1 = sha1 if sha1 is not None else hashlib.sha1(data).hexdigest()
+        with self.lock, self.conn:
+            if self.conn.execute('SELECT 1 FROM objects WHERE hash = ?', (sha1,)).fetchone() is None:
+                if self._tar is None or self._tar.offset >= self.shard_size:
+                    self._close_shard()
+                    self._open_shard()
+                info = tarfile.TarInfo(f'{sha1}{Path(name).suffix}')
+                info.size = len(data)
+                info.mtime = int(time.time())
+                offset = self._tar.offset + len(info.tobuf(self._tar.format, self._tar.encoding, self._tar.errors))
+                self._tar.addfile(info, io.BytesIO(data))
+                self._tar.members = []
+                self._tar.fileobj.flush()
+                self.conn.execute('INSERT INTO objects VALUES (?, ?, ?, ?)', (sha1, self._shard, offset, len(data)))
+            self.conn.execute('INSERT OR REPLACE INTO names VALUES (?, ?, ?)', (name, sha1, len(data)))
+
+    @contextlib.contextmanager
+    def writer(self, name):
+        """Same as `FigureStore.writer`, buffered in memory, without a "path"."""
+        fp = _ObjectFile(io.BytesIO())
+        yield fp
+        data = fp.fp.getvalue()
+        fp.sha1 = hashlib.sha1(data).hexdigest()
+        fp.size = len(data)
+        self.put_bytes(name, data, fp.sha1)
+
+    def put_file(self, name, pathname, sha1=None):
+        """Stores a file under name. Given its SHA-1, a content that is already stored is not read again."""
+        if sha1 is not None:
+            with self.lock:
+                row = self.conn.execute('SELECT size FROM objects WHERE hash = ?', (sha1,)).fetchone()
+                if row is not None:
+                    with self.conn:
+                        self.conn.execute('INSERT OR REPLACE INTO names VALUES (?, ?, ?)', (name, sha1, row[0]))
+                    return
+        with open(pathname, 'rb') as fp:
+            self.put_bytes(name, fp.read(), sha1)
+
+
+def open_store(root):
+    """The ShardStore in root if it has a shard index, otherwise the FigureStore in root."""
+    return ShardStore(root) if (Path(root) / SHARD_INDEX).exists() else FigureStore(root)
+
+
+class _ObjectFile:
+    def __init__(self, fp):
+        self.fp = fp
+        self.sha1 = None
+        self.size = None
+        self.path = None
+
+    def __getattr__(self, item):
+        return getattr(self.fp, item)
+
+
+def migrate(src_dir, dest_dir, move=False):
+    """
+    Stores the files of a flat folder under their file names, in a single listing of the folder. The empty files that
+    marked missing figures are stored as empty objects, and the dot files, e.g., the manifest and the validators of
+    get_figures, are copied as they are.
+    """
+    store = FigureStore(dest_dir)
+    stored = store.stat()
+    cnt = collections.Counter()
+    with os.scandir(src_dir) as it:
+        entries = [entry for entry in it if entry.is_file()]
+    for entry in tqdm.tqdm(entries, desc='Migrate'):
+        if entry.name.startswith('.'):
+            if Path(src_dir).resolve() != Path(dest_dir).resolve() and not (Path(dest_dir) / entry.name).exists():
+                shutil.copy2(entry.path, Path(dest_dir) / entry.name)
+                cnt['dot file'] += 1
+            continue
+        if entry.name in stored:
+            cnt['already stored'] += 1
+        else:
+            store.put_file(entry.name, entry.path)
+            cnt['stored'] += 1
+        if move:
+            os.remove(entry.path)
+    cnt['object'] = len({sha1 for _, sha1 in store.stat().values()})
+    store.close()
+    return cnt
+
+
+def pack(src_dir, dest_dir, shard_size=1 << 30):
+    """Packs the names of a figure store that are not yet in the shards of dest_dir."""
+    store = FigureStore(src_dir)
+    shards = ShardStore(dest_dir, shard_size)
+    packed = shards.stat()
+    stat = {name: v for name, v in store.stat().items() if name not in packed}
+    cnt = collections.Counter()
+    for name, path in tqdm.tqdm(store.paths(stat).items(), total=len(stat), desc='Pack'):
+        shards.put_file(name, path, stat[name][1])
+        cnt['packed'] += 1
+    cnt['already packed'] = len(packed)
+    store.close()
+    shards.close()
+    return cnt
+
+
+if __name__ == '__main__':
+    args = docopt.docopt(__doc__)
+    if args['migrate']:
+        cnt = migrate(src_dir=Path(args['-i']), dest_dir=Path(args['-o']), move=args['--move'])
+    elif args['pack']:
+        cnt = pack(src_dir=Path(args['-i']), dest_dir=Path(args['-o']), shard_size=int(args['--shard-size']) << 20)
+    else:
+        store = FigureStore(Path(args['STORE_DIR']))
+        cnt = store.prune()
+        store.close()
+    for k, v in cnt.most_common():
+        print(k, ':', v)
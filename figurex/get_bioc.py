@@ -1,59 +1,99 @@
 """
 Usage:
-    script.py -i SOURCE -o DEST_DIR
+    script.py [options] -i SOURCE -o DEST_DIR
 
 Options:
     -i <file>           PMC csv file
     -o <directory>      BioC folder
+    --workers <int>     Number of concurrent downloads [default: 4]
+    --rate <float>      Maximum requests per second, 3 without an NCBI API key [default: 3]
+    --manifest <file>   Manifest of the BioC files, DEST_DIR/.manifest.db by default
+    --retry-missing     Request again the articles that had no BioC
+    --url <str>         BioC url, with {} for the pmid [default: https://www.ncbi.nlm.nih.gov/research/bionlp/RESTful/pmcoa.cgi/BioC_xml/{}/unicode]
 """
 
 import collections
-import urllib.error
-import urllib.request
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import docopt
-import pandas as pd
+import requests
 import tqdm
 
-from figurex.utils import is_file_not_empty
+from figurex.utils import MANIFEST_FILE, Manifest, RateLimiter, atomic_write, get_with_retry, http_session, read_table
 
+BIOC_URL = 'https://www.ncbi.nlm.nih.gov/research/bionlp/RESTful/pmcoa.cgi/BioC_xml/{}/unicode'
 
-def get_bioc(pmid, dest):
-    url = f'https://www.ncbi.nlm.nih.gov/research/bionlp/RESTful/pmcoa.cgi/BioC_xml/{pmid}/unicode'
-    response = urllib.request.urlopen(url)
-    data = response.read()
-    text = data.decode('utf-8')
-    with open(dest, 'w', encoding='utf8') as fp:
+
+def get_bioc(pmid, dest, session=None, rate_limiter=None, url=BIOC_URL):
+    """
+    Returns:
+        size and SHA-1 of the BioC file
+    """
+    session = session if session is not None else requests.Session()
+    response = get_with_retry(session, url.format(pmid), rate_limiter)
+    response.raise_for_status()
+    text = response.content.decode('utf-8')
+    with atomic_write(dest, 'w', encoding='utf8') as fp:
         fp.write(text)
+    data = text.encode('utf8')
+    return len(data), hashlib.sha1(data).hexdigest()
 
 
-def get_bioc_f(src, dest_dir):
-    df = pd.read_csv(src, dtype=str)
+def get_bioc_f(src, dest_dir, workers=4, rate=3, url=BIOC_URL, manifest=None, retry_missing=False):
+    """
+    Downloads the BioC files of the PMCIDs that are not OK in the manifest, or MISSING unless retry_missing. Articles
+    without BioC are recorded as MISSING in the manifest instead of an empty file.
+    """
+    df = read_table(src, columns=['pmid', 'pmcid'], dtype=str)
+    pmids = {pmc: pmid for pmid, pmc in zip(df['pmid'], df['pmcid']) if pmid}
     cnt = collections.Counter()
-    for pmid, pmc in tqdm.tqdm(zip(df['pmid'], df['pmcid']), total=len(df)):
-        if not pmid:
-            continue
+    cnt['total pmc'] = len(pmids)
 
-        cnt['total pmc'] += 1
-        biocfile = dest_dir / f'{pmc}.xml'
+    manifest = Manifest(manifest if manifest is not None else dest_dir / MANIFEST_FILE)
+    manifest.adopt('bioc', dest_dir, pmids, lambda pmc: f'{pmc}.xml')
+    todo = manifest.todo('bioc', pmids, retry_missing)
 
-        if biocfile.exists():
-            if is_file_not_empty(biocfile):
-                cnt['total bioc'] += 1
-            continue
+    session = http_session(workers)
+    rate_limiter = RateLimiter(rate)
 
+    def _fetch(pmc):
         try:
-            get_bioc(pmid, biocfile)
-            cnt['total_bioc'] += 1
-            cnt['new bioc'] += 1
-        except urllib.error.HTTPError:
-            with open(biocfile, 'w') as _:
-                pass
+            size, sha1 = get_bioc(pmids[pmc], dest_dir / f'{pmc}.xml', session, rate_limiter, url)
+            return {'item': pmc, 'status': Manifest.OK, 'size': size, 'hash': sha1}
+        except requests.HTTPError as e:
+            code = e.response.status_code
+            # the article has no BioC: it is not requested again
+            status = Manifest.FAILED if code == 429 or code >= 500 else Manifest.MISSING
+            return {'item': pmc, 'status': status, 'code': code, 'error': repr(e)}
+        except requests.RequestException as e:
+            return {'item': pmc, 'status': Manifest.FAILED, 'error': repr(e)}
+
+    records = []
+    with ThreadPoolExecutor(workers) as executor:
+        for record in tqdm.tqdm(executor.map(_fetch, todo), total=len(todo)):
+            cnt[{Manifest.OK: 'new bioc', Manifest.MISSING: 'Http error'}.get(record['status'], 'failed')] += 1
+            records.append(record)
+            if len(records) >= 100:
+                manifest.put('bioc', records)
+                records = []
+    manifest.put('bioc', records)
+
+    status = manifest.status('bioc')
+    cnt['total bioc'] = sum(1 for pmc in pmids if status.get(pmc) == Manifest.OK)
+    manifest.close()
+
     for k, v in cnt.most_common():
         print(k, ':', v)
 
 
 if __name__ == '__main__':
     args = docopt.docopt(__doc__)
-    get_bioc_f(src=args['-i'], dest_dir=Path(args['-o']))
+    get_bioc_f(src=args['-i'],
+               dest_dir=Path(args['-o']),
+               workers=int(args['--workers']),
+               rate=float(args['--rate']),
+               url=args['--url'],
+               manifest=Path(args['--manifest']) if args['--manifest'] else None,
+               retry_missing=args['--retry-missing'])
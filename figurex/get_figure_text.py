@@ -4,20 +4,23 @@ Usage:
 
 Options:
     -i <file>       Gold standard file
-    -o <file>       BioC Xml file
+    -o <file>       BioC Xml file, written as JSON Lines if it ends with .jsonl
     -b <dir>        bioc dir
+    -x <file>       BioC index file, see bioc_index.py
+    --compact       Do not indent the JSON file
 """
 
-import json
-import re
+import collections
 from pathlib import Path
 from typing import Dict, List
 
 import bioc
 import docopt
-import pandas as pd
 import tqdm
 
+from figurex.bioc_index import FIG_ID, BiocIndex, referred_figures
+from figurex.utils import json_writer, read_table
+
 
 class OneFigure:
     def __init__(self):
@@ -47,19 +50,31 @@ def df_to_obj(df) -> List[OneFigure]:
     return objs
 
 
-def get_figure_referred_text(doc: bioc.BioCDocument, figure_id):
-    p = re.compile(r'(\d)+$')
-    m = p.search(figure_id)
-    sentences = []
-    if m:
-        id = int(m.group())
-        s = '[F|f]ig(ure)?.?\\s{}'.format(id)
-        fig_pattern = re.compile(s)
-        for passage in doc.passages:
-            m = fig_pattern.search(passage.text)
-            if m:
-                sentences.append(passage)
-    return sentences
+def get_figure_references(doc: bioc.BioCDocument) -> Dict[int, List[bioc.BioCPassage]]:
+    """
+    Scans the passages of a document once.
+
+    Returns:
+        Dict: figure number -> passages referring to the figure, in document order
+    """
+    references = collections.defaultdict(list)
+    for passage in doc.passages:
+        for number in referred_figures(passage.text):
+            references[number].append(passage)
+    return references
+
+
+def get_figure_referred_text(doc: bioc.BioCDocument, figure_id, references=None):
+    """
+    Args:
+        references: the result of `get_figure_references(doc)`, to reuse it across the figures of the document
+    """
+    m = FIG_ID.search(figure_id)
+    if not m:
+        return []
+    if references is None:
+        references = get_figure_references(doc)
+    return list(references.get(int(m.group()), []))
 
 
 def passage_to_dict(passage: bioc.BioCPassage):
@@ -71,40 +86,71 @@ def passage_to_dict(passage: bioc.BioCPassage):
     return d
 
 
-def get_figure_caption(figure: OneFigure, doc: bioc.BioCDocument):
+def get_figure_caption(figure: OneFigure, doc: bioc.BioCDocument, references=None):
     filename = figure.url[figure.url.rfind('/') + 1:]
     for p in doc.passages:
         if len(p.text) == 0:
             continue
         if 'file' in p.infons and p.infons["file"] == filename:
             figure.text.append(p)
-            passages = get_figure_referred_text(doc, p.infons['id'])
+            passages = get_figure_referred_text(doc, p.infons['id'], references)
             figure.text.extend(passages)
             return
 
 
-def add_text(objs: List[OneFigure], bioc_dir):
-    for obj in objs:
-        pmcid = obj.pmcid
-        with open(bioc_dir / f'{pmcid}.xml', encoding='utf8') as fp:
-            collection = bioc.load(fp)
-            for doc in collection.documents:
-                get_figure_caption(obj, doc)
-    return objs
+def add_text(objs: List[OneFigure], bioc_dir, index=None):
+    return list(iter_text(objs, bioc_dir, index))
 
 
-def get_figure_text(src, dest, bioc_dir):
-    df = pd.read_csv(src, dtype=str)
+def iter_text(objs: List[OneFigure], bioc_dir, index=None):
+    """Same as `add_text`, but yields each figure as soon as its text is added."""
+    if index is not None:
+        yield from iter_text_from_index(objs, bioc_dir, index)
+        return
+    # objs are sorted by pmcid, so each article is loaded and scanned once for all its figures
+    pmcid, documents = None, []
+    for obj in objs:
+        if obj.pmcid != pmcid:
+            pmcid = obj.pmcid
+            with open(bioc_dir / f'{pmcid}.xml', encoding='utf8') as fp:
+                collection = bioc.load(fp)
+            documents = [(doc, get_figure_references(doc)) for doc in collection.documents]
+        for doc, references in documents:
+            get_figure_caption(obj, doc, references)
+        yield obj
+
+
+def iter_text_from_index(objs: List[OneFigure], bioc_dir, index):
+    """Same as `iter_text`, from a BioC index. Articles missing from the index or changed are indexed first."""
+    index = BiocIndex(index)
+    try:
+        index.update(sorted({obj.pmcid for obj in objs}), bioc_dir)
+        for obj in objs:
+            filename = obj.url[obj.url.rfind('/') + 1:]
+            obj.text.extend(index.figure_text(obj.pmcid, filename))
+            yield obj
+    finally:
+        index.close()
+
+
+def get_figure_text(src, dest, bioc_dir, index=None, indent=2):
+    """
+    Writes each figure to dest as soon as its text is found, so the figures and their passages are not all held in
+    memory.
+    """
+    df = read_table(src, columns=['pmcid', 'figure url', 'label'], dtype=str)
     objs = df_to_obj(df)
-    objs = add_text(objs, bioc_dir)
-    objs = [o.to_dict() for o in objs]
-    with open(dest, 'w', encoding='utf8') as fp:
-        json.dump(objs, fp, indent=2)
+    with json_writer(dest, indent=indent) as writer:
+        for obj in iter_text(objs, bioc_dir, index):
+            writer.write(obj.to_dict())
+            obj.text = []
 
 
 if __name__ == '__main__':
     args = docopt.docopt(__doc__)
     get_figure_text(src=Path(args['-i']),
                     dest=Path(args['-o']),
-                    bioc_dir=Path(args['-b']))
+                    bioc_dir=Path(args['-b']),
+                    index=Path(args['-x']) if args['-x'] else None,
+                    indent=None if args['--compact'] else 2)
 
@@ -6,18 +6,24 @@ Options:
     -i <file>       PMC csv file
     -o <file>       Total figure csv file
     -b <dir>        BioC folder
+    -x <file>       BioC index file, see bioc_index.py
     --overwrite
+    --processes <int>   Number of processes parsing BioC files [default: 1]
+    --chunksize <int>   Number of articles sent to a process at once [default: 16]
 """
 
 import collections
+import csv
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-import bioc
 import docopt
 import pandas as pd
 import tqdm
+from lxml import etree
 
-from figurex.utils import is_file_not_empty
+from figurex.bioc_index import BiocIndex
+from figurex.utils import atomic_write, is_file_not_empty, read_table, table_format, write_table
 
 FIG_PASSAGE = {"fig_caption",
                "fig_title_caption",
@@ -29,45 +35,117 @@ FIG_PASSAGE = {"fig_caption",
 Figure = collections.namedtuple('figure', 'PMC url caption')
 
 
+def iter_figure_passages(bioc_file):
+    """
+    Streams the passages of a BioC XML file whose "type" infon is in FIG_PASSAGE, without building the bioc object
+    model. Passages and documents are cleared once read, so memory does not grow with the size of the article.
+
+    Yields:
+        (infons, text) of the figure passages, in document order
+    """
+    for _, elem in etree.iterparse(str(bioc_file), events=('end',), tag=('passage', 'document')):
+        if elem.tag == 'passage':
+            infons = {child.get('key'): child.text for child in elem.iterchildren('infon')}
+            if infons.get('type') in FIG_PASSAGE:
+                yield infons, elem.findtext('text', default='')
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
 def get_figure_link(pmc, bioc_file):
-    with open(bioc_file, encoding='utf8') as fp:
-        c = bioc.load(fp)
+    figures = []
+    for infons, text in iter_figure_passages(bioc_file):
+        if len(text) != 0 and 'file' in infons:
+            url = f'https://www.ncbi.nlm.nih.gov/pmc/articles/{pmc}/bin/{infons["file"]}'
+            caption = text.replace('\n', ' ')
+            figures.append(Figure(pmc, url, caption))
+    return figures
+
 
+def get_figure_link_from_index(pmc, index: BiocIndex):
+    """Same as `get_figure_link`, from a BioC index."""
     figures = []
-    for doc in c.documents:
-        for p in doc.passages:
-            if len(p.text) == 0:
-                continue
-            p.text = p.text.replace('\n', ' ')
-            if 'file' in p.infons and 'type' in p.infons and p.infons['type'] in FIG_PASSAGE:
-                url = f'https://www.ncbi.nlm.nih.gov/pmc/articles/{pmc}/bin/{p.infons["file"]}'
-                caption = p.text.replace('\n', ' ')
-                f = Figure(pmc, url, caption)
-                figures.append(f)
+    for p in index.figure_passages(pmc):
+        if 'type' in p['infons'] and p['infons']['type'] in FIG_PASSAGE:
+            url = f'https://www.ncbi.nlm.nih.gov/pmc/articles/{pmc}/bin/{p["infons"]["file"]}'
+            caption = p['text'].replace('\n', ' ')
+            figures.append(Figure(pmc, url, caption))
     return figures
 
 
-def get_figure_caption(src, dest, bioc_dir, overwrite=False):
+def figure_rows(pmc, bioc_file):
+    """
+    Returns:
+        List: (pmcid, figure url) rows of an article
+    """
+    if not is_file_not_empty(bioc_file):
+        return []
+    return [(pmc, f.url[f.url.rfind('/') + 1:]) for f in get_figure_link(pmc, bioc_file)]
+
+
+def figure_rows_chunk(pmcids, bioc_files):
+    """`figure_rows` of a chunk of articles, run in one task of the process pool."""
+    return [figure_rows(pmc, bioc_file) for pmc, bioc_file in zip(pmcids, bioc_files)]
+
+
+def unique_rows(rows):
+    """Flattens the rows of the articles, dropping duplicates."""
+    seen = set()
+    for article_rows in rows:
+        for row in article_rows:
+            if row not in seen:
+                seen.add(row)
+                yield row
+
+
+def get_figure_caption(src, dest, bioc_dir, overwrite=False, index=None, processes=1, chunksize=16):
+    """
+    Writes the figures of each article to dest as soon as the article is parsed. With processes > 1, the BioC files
+    are parsed in a process pool; results are still written in the order of src, so the output does not depend on
+    the number of processes.
+    """
     if dest.exists() and not overwrite:
         print('%s will not be overwritten' % dest.name)
         return
 
-    df = pd.read_csv(src, dtype=str)
-
-    data = []
-    for pmc in tqdm.tqdm(df['pmcid'], total=len(df)):
-        biocfile = bioc_dir / f'{pmc}.xml'
-        if is_file_not_empty(biocfile):
-            figures = get_figure_link(pmc, biocfile)
-            for f in figures:
-                data.append({
-                    'pmcid': pmc,
-                    'figure url': f.url[f.url.rfind('/') + 1:]
-                })
-
-    df = pd.DataFrame(data)
-    df = df.drop_duplicates()
-    df.to_csv(dest, index=False)
+    df = read_table(src, columns=['pmcid'], dtype=str)
+    pmcids = list(df['pmcid'])
+    executor = None
+    futures = []
+    if index is not None:
+        index = BiocIndex(index)
+        index.update(pmcids, bioc_dir)
+        rows = ([(pmc, f.url[f.url.rfind('/') + 1:]) for f in get_figure_link_from_index(pmc, index)]
+                for pmc in pmcids)
+    elif processes > 1:
+        executor = ProcessPoolExecutor(processes)
+        # one future per chunk, so that the pending ones can be cancelled if writing fails
+        futures = [executor.submit(figure_rows_chunk, pmcids[i: i + chunksize],
+                                   [bioc_dir / f'{pmc}.xml' for pmc in pmcids[i: i + chunksize]])
+                   for i in range(0, len(pmcids), chunksize)]
+        rows = (article_rows for future in futures for article_rows in future.result())
+    else:
+        rows = (figure_rows(pmc, bioc_dir / f'{pmc}.xml') for pmc in pmcids)
+
+    try:
+        rows = unique_rows(tqdm.tqdm(rows, total=len(pmcids)))
+        if table_format(dest) == 'csv':
+            with atomic_write(dest, newline='', encoding='utf8') as fp:
+                writer = csv.writer(fp, lineterminator='\n')
+                writer.writerow(['pmcid', 'figure url'])
+                writer.writerows(rows)
+        else:
+            # columnar files are written at once
+            write_table(pd.DataFrame(list(rows), columns=['pmcid', 'figure url']), dest)
+    finally:
+        if executor is not None:
+            # cancel_futures of shutdown needs Python 3.9
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+        if index is not None:
+            index.close()
 
 
 if __name__ == '__main__':
@@ -75,4 +153,7 @@ if __name__ == '__main__':
     get_figure_caption(src=Path(args['-i']),
                        dest=Path(args['-o']),
                        bioc_dir=Path(args['-b']),
-                       overwrite=args['--overwrite'])
+                       overwrite=args['--overwrite'],
+                       index=Path(args['-x']) if args['-x'] else None,
+                       processes=int(args['--processes']),
+                       chunksize=int(args['--chunksize']))
@@ -5,49 +5,158 @@ Usage:
 Options:
     -i <file>   Figure csv file
     -o <file>   Local figure csv file
-    -f <dir>    Figure folder
+    -f <dir>    Figure store folder
+    --workers <int>     Number of concurrent downloads [default: 8]
+    --rate <float>      Maximum requests per second to each host [default: 3]
+    --refresh           Check the downloaded figures with conditional requests and update the changed ones
+    --manifest <file>   Manifest of the figures, FIGURE_DIR/.manifest.db by default
+    --retry-missing     Request again the figures that could not be downloaded
 """
 
 import collections
-import urllib.error
-import urllib.request
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from urllib.parse import urlparse
 
 import docopt
-import pandas as pd
+import requests
 import tqdm
 
+from figurex.figure_store import FigureStore
+from figurex.utils import MANIFEST_FILE, Manifest, RateLimiter, atomic_write, get_with_retry, http_session, \
+    read_table, write_table
 
-def get_figures(src, dest, image_dir):
-    figure_df = pd.read_csv(src)
+FIGURE_URL = 'https://www.ncbi.nlm.nih.gov/pmc/articles/{}/bin/{}'
+# ETag and Last-Modified of the downloaded figures, in the figure folder
+VALIDATORS_FILE = '.validators.json'
+
+
+def download_figure(session, url, store, filename, validator=None, rate_limiter=None):
+    """
+    Downloads a figure into the store, or only checks that it did not change if its validator from a previous download
+    is given.
+
+    Returns:
+        'new figure' or 'not modified'
+        number of bytes written
+        SHA-1 of the new figure, or None if not modified
+        validator of the figure: its ETag and Last-Modified headers
+    """
+    headers = {}
+    if validator:
+        if 'etag' in validator:
+            headers['If-None-Match'] = validator['etag']
+        if 'last-modified' in validator:
+            headers['If-Modified-Since'] = validator['last-modified']
+    response = get_with_retry(session, url, rate_limiter, headers=headers, stream=True)
+    with response:
+        if response.status_code == 304:
+            return 'not modified', 0, None, validator
+        response.raise_for_status()
+        with store.writer(filename) as fp:
+            for chunk in response.iter_content(1 << 16):
+                fp.write(chunk)
+        validator = {k: response.headers[h] for k, h in (('etag', 'ETag'), ('last-modified', 'Last-Modified'))
+                     if h in response.headers}
+        return 'new figure', fp.size, fp.sha1, validator
+
+
+def figure_filenames(figure_df):
+    """Local file names of the figures: {pmcid}_{figure url}."""
+    return figure_df['pmcid'].astype(str) + '_' + figure_df['figure url'].astype(str)
+
+
+def get_figures(src, dest, image_dir, workers=8, rate=3, refresh=False, manifest=None, retry_missing=False):
+    """
+    Downloads the figures that are not OK in the manifest, or MISSING unless retry_missing. Figures that cannot be
+    downloaded are recorded as MISSING in the manifest instead of an empty file.
+    """
+    figure_df = read_table(src)
+
+    validators_file = image_dir / VALIDATORS_FILE
+    validators = {}
+    if validators_file.exists():
+        with open(validators_file) as fp:
+            validators = json.load(fp)
 
-    data = []
     cnt = collections.Counter()
-    for _, row in tqdm.tqdm(figure_df.iterrows(), total=len(figure_df)):
-        pmc = row['pmcid']
-        local_file = image_dir / '{}_{}'.format(pmc, row['figure url'])
-        if not local_file.exists():
-            url = 'https://www.ncbi.nlm.nih.gov/pmc/articles/{}/bin/{}'.format(pmc, row['figure url'])
-            try:
-                urllib.request.urlretrieve(url, local_file)
-                cnt['new figure'] += 1
-            except urllib.error.HTTPError:
-                cnt['Http error'] += 1
-                with open(local_file, 'w') as _:
-                    pass
-        row['figure filename'] = str(local_file.name)
-        cnt['total figure'] += 1
-        data.append(row)
-
-    df = pd.DataFrame(data)
-    df.to_csv(dest, index=False)
+    figure_df = figure_df.assign(**{'figure filename': figure_filenames(figure_df)})
+    cnt['total figure'] = len(figure_df)
+    urls = dict(zip(figure_df['figure filename'], map(FIGURE_URL.format, figure_df['pmcid'], figure_df['figure url'])))
+
+    store = FigureStore(image_dir)
+    manifest = Manifest(manifest if manifest is not None else image_dir / MANIFEST_FILE)
+    manifest.adopt_store('figures', store, urls)
+    status = manifest.status('figures')
+    todo = manifest.todo('figures', urls, retry_missing)
+    if refresh:
+        todo += [filename for filename in urls if status.get(filename) == Manifest.OK]
+
+    session = http_session(workers)
+    rate_limiters = {host: RateLimiter(rate) for host in {urlparse(urls[filename]).netloc for filename in todo}}
+
+    def _download(filename):
+        url = urls[filename]
+        # only figures downloaded before are checked
+        downloaded = status.get(filename) == Manifest.OK
+        validator = validators.get(filename) if downloaded else None
+        try:
+            result, size, sha1, validator = download_figure(session, url, store, filename, validator,
+                                                            rate_limiters[urlparse(url).netloc])
+        except requests.HTTPError as e:
+            code = e.response.status_code
+            if code == 429 or code >= 500 or downloaded:
+                # a figure downloaded before stays OK
+                record = None if downloaded else {'item': filename, 'status': Manifest.FAILED, 'code': code,
+                                                  'error': repr(e)}
+                return 'failed', 0, record, None
+            return 'Http error', 0, {'item': filename, 'status': Manifest.MISSING, 'code': code, 'error': repr(e)}, None
+        except requests.RequestException as e:
+            record = None if downloaded else {'item': filename, 'status': Manifest.FAILED, 'error': repr(e)}
+            return 'failed', 0, record, None
+        if result == 'not modified':
+            return result, size, None, validator
+        return result, size, {'item': filename, 'status': Manifest.OK, 'size': size, 'hash': sha1}, validator
+
+    start = time.perf_counter()
+    total_size = 0
+    records = []
+    with ThreadPoolExecutor(workers) as executor:
+        for result, size, record, validator in tqdm.tqdm(executor.map(_download, todo), total=len(todo)):
+            cnt[result] += 1
+            total_size += size
+            if record is not None:
+                records.append(record)
+                if validator:
+                    validators[record['item']] = validator
+            if len(records) >= 100:
+                manifest.put('figures', records)
+                records = []
+    manifest.put('figures', records)
+    manifest.close()
+    store.close()
+    elapsed = time.perf_counter() - start
+
+    with atomic_write(validators_file) as fp:
+        json.dump(validators, fp)
+
+    write_table(figure_df, dest)
 
     for k, v in cnt.most_common():
         print(k, ':', v)
+    if todo:
+        print('throughput : %.1f files/s, %.2f MB/s' % (len(todo) / elapsed, total_size / elapsed / 1e6))
 
 
 if __name__ == '__main__':
     args = docopt.docopt(__doc__)
     get_figures(src=Path(args['-i']),
                 dest=Path(args['-o']),
-                image_dir=Path(args['-f']))
+                image_dir=Path(args['-f']),
+                workers=int(args['--workers']),
+                rate=float(args['--rate']),
+                refresh=args['--refresh'],
+                manifest=Path(args['--manifest']) if args['--manifest'] else None,
+                retry_missing=args['--retry-missing'])
@@ -7,54 +7,111 @@ Options:
     -o <directory>      MedLine folder
     --email <str>       E-utils email
     --api-key <str>     E-utils API key
+    --workers <int>     Number of concurrent requests [default: 4]
+    --rate <float>      Maximum requests per second, 10 with an API key [default: 10]
+    --manifest <file>   Manifest of the fetched, missing and failed PMCIDs, DEST/.manifest.db by default
+    --retry-missing     Request again the PMCIDs for which E-utils returned no record
 """
 
+import collections
+import hashlib
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
 from pathlib import Path
 
 import docopt
-import pandas as pd
 import tqdm
 from Bio import Entrez, Medline
 
+from figurex.utils import MANIFEST_FILE, Manifest, RateLimiter, atomic_write, read_table
 
-def get_medline(pmcids, dst_dir):
-    fetch_handle = Entrez.efetch(db="pmc", rettype="medline", retmode="text", id=','.join(pmcids))
-    try:
-        data = fetch_handle.read()
-        fetch_handle.close()
-    except:
-        return
+
+def get_medline(pmcids, dst_dir, rate_limiter=None, retries=3, backoff=1.):
+    """
+    Fetches a batch of PMCIDs, retrying failed requests with exponential backoff.
+
+    Returns:
+        Dict: PMCID -> size and SHA-1 of its record, for the PMCIDs written to dst_dir
+    """
+    for attempt in range(retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.wait()
+        try:
+            fetch_handle = Entrez.efetch(db="pmc", rettype="medline", retmode="text", id=','.join(pmcids))
+            data = fetch_handle.read()
+            fetch_handle.close()
+            break
+        except (OSError, RuntimeError):
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+    fetched = {}
     for record in Medline.parse(StringIO(data)):
         try:
             pmcid = record['PMC']
-            dst = dst_dir / f'{pmcid}.json'
-            with open(dst, 'w') as fp:
-                json.dump(record, fp, indent=2)
-        except:
+        except KeyError:
             print('Cannot find', str(json.dumps(record, indent=2)))
             continue
+        dst = dst_dir / f'{pmcid}.json'
+        text = json.dumps(record, indent=2)
+        with atomic_write(dst, 'w') as fp:
+            fp.write(text)
+        data = text.encode('utf8')
+        fetched[pmcid] = len(data), hashlib.sha1(data).hexdigest()
+    return fetched
 
 
-def get_medline_file(src, dst_dir, batch_size=200):
-    df = pd.read_csv(src)
+def get_medline_file(src, dst_dir, batch_size=200, workers=4, rate=10, manifest=None, retry_missing=False):
+    df = read_table(src, columns=['pmcid'])
     total_pmcids = list(df['pmcid'])
     print('Total pmcids', len(total_pmcids))
-    pmcids = []
-    for pmcid in tqdm.tqdm(df['pmcid'], total=len(df['pmcid'])):
-        dst = dst_dir / f'{pmcid}.json'
-        if not dst.exists():
-            pmcids.append(pmcid)
-            if len(pmcids) == batch_size:
-                get_medline(pmcids, dst_dir)
-                pmcids = []
-    if pmcids:
-        get_medline(pmcids, dst_dir)
+
+    manifest = Manifest(manifest if manifest is not None else dst_dir / MANIFEST_FILE)
+    manifest.adopt('medline', dst_dir, total_pmcids, lambda pmcid: f'{pmcid}.json')
+    pmcids = manifest.todo('medline', total_pmcids, retry_missing)
+    print('Pmcids to fetch', len(pmcids))
+
+    rate_limiter = RateLimiter(rate)
+    batches = [pmcids[i: i + batch_size] for i in range(0, len(pmcids), batch_size)]
+
+    def _fetch(batch):
+        try:
+            return batch, get_medline(batch, dst_dir, rate_limiter), None
+        except Exception as e:
+            return batch, {}, e
+
+    cnt = collections.Counter()
+    with ThreadPoolExecutor(workers) as executor:
+        for batch, fetched, error in tqdm.tqdm(executor.map(_fetch, batches), total=len(batches)):
+            records = []
+            for pmcid in batch:
+                if error is not None:
+                    record = {'item': pmcid, 'status': Manifest.FAILED, 'error': repr(error)}
+                elif pmcid in fetched:
+                    size, sha1 = fetched[pmcid]
+                    record = {'item': pmcid, 'status': Manifest.OK, 'size': size, 'hash': sha1}
+                else:
+                    record = {'item': pmcid, 'status': Manifest.MISSING}
+                records.append(record)
+                cnt[record['status']] += 1
+            manifest.put('medline', records)
+            if error is not None:
+                print('Cannot fetch batch starting at', batch[0], ':', repr(error))
+    manifest.close()
+
+    for k, v in cnt.most_common():
+        print(k, ':', v)
 
 
 if __name__ == '__main__':
     args = docopt.docopt(__doc__)
     Entrez.email = args['--email']
     Entrez.api_key = args['--api-key']
-    get_medline_file(Path(args['-i']), Path(args['-o']))
+    get_medline_file(Path(args['-i']), Path(args['-o']),
+                     workers=int(args['--workers']),
+                     rate=float(args['--rate']),
+                     manifest=Path(args['--manifest']) if args['--manifest'] else None,
+                     retry_missing=args['--retry-missing'])
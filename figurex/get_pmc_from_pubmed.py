@@ -6,9 +6,15 @@ Options:
     -i <file>       LitCovid file
     -o <file>       PMC file
     -l <file>       History PMC file
+    --cache <file>      Persistent PMID to PMCID/DOI cache
+    --workers <int>     Number of concurrent requests [default: 4]
+    --rate <float>      Maximum requests per second [default: 3]
 """
 
+import csv
 import io
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Dict
 import docopt
@@ -16,52 +22,106 @@ import pandas as pd
 import requests
 import tqdm
 
+from figurex.utils import RateLimiter, get_with_retry, http_session, read_table, write_table
+
+IDCONV_URL = 'https://www.ncbi.nlm.nih.gov/pmc/utils/idconv/v1.0/?tool=my_tool&format=csv&email=yifan.peng@nih.gov&ids='
 
-def get_pmc_from_pmid(pmids: List[str]) -> Dict:
-    assert len(pmids) <= 200
-    url = 'https://www.ncbi.nlm.nih.gov/pmc/utils/idconv/v1.0/?tool=my_tool&format=csv&email=yifan.peng@nih.gov&ids='
-    url += ','.join(pmids)
-    x = requests.get(url)
-    f = io.StringIO(x.text.strip())
-    pmcdf = pd.read_csv(f, dtype=str)
 
+def parse_idconv(text: str) -> Dict:
     rst = {}
-    for pmid, pmcid, doi in zip(pmcdf['PMID'], pmcdf['PMCID'], pmcdf['DOI']):
-        if not pd.isna(pmcid):
-            rst[pmid] = {'pmcid': pmcid, 'doi': doi}
+    for row in csv.DictReader(io.StringIO(text.strip())):
+        if row.get('PMCID'):
+            rst[row['PMID']] = {'pmcid': row['PMCID'], 'doi': row.get('DOI') or None}
     return rst
 
 
-def get_pmc_from_pmid_f(src, dest, history=None):
+def get_pmc_from_pmid(pmids: List[str], session=None, rate_limiter=None) -> Dict:
+    assert len(pmids) <= 200
+    url = IDCONV_URL + ','.join(pmids)
+    session = session if session is not None else requests.Session()
+    x = get_with_retry(session, url, rate_limiter)
+    x.raise_for_status()
+    return parse_idconv(x.text)
+
+
+class IdCache:
+    """
+    Persistent map of the PMIDs already resolved to a PMCID, so that they are never requested again.
+    """
+
+    def __init__(self, pathname):
+        self.conn = sqlite3.connect(str(pathname))
+        self.conn.execute('CREATE TABLE IF NOT EXISTS ids (pmid TEXT PRIMARY KEY, pmcid TEXT, doi TEXT)')
+
+    def get(self, pmids: List[str], chunk_size=500) -> Dict:
+        rst = {}
+        for i in range(0, len(pmids), chunk_size):
+            chunk = pmids[i: i + chunk_size]
+            cursor = self.conn.execute('SELECT pmid, pmcid, doi FROM ids WHERE pmid IN (%s)'
+                                       % ','.join('?' * len(chunk)), chunk)
+            for pmid, pmcid, doi in cursor:
+                rst[pmid] = {'pmcid': pmcid, 'doi': doi}
+        return rst
+
+    def put(self, results: Dict):
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO ids VALUES (?, ?, ?)',
+                                  [(k, v['pmcid'], v['doi']) for k, v in results.items()])
+
+    def close(self):
+        self.conn.close()
+
+
+def get_pmc_from_pmid_f(src, dest, history=None, cache=None, workers=4, rate=3):
     litcovid_df = pd.read_csv(src, sep='\t', dtype=str, comment='#')
     litcovid_data = {row['pmid']: row for _, row in litcovid_df.iterrows()}
 
     new_pmids = set(litcovid_df['pmid'])
     if history is not None:
-        history_df = pd.read_csv(history, dtype=str)
+        history_df = read_table(history, dtype=str)
         new_pmids = new_pmids - set(history_df['pmid'])
 
     pmids = list(new_pmids)
+    results = {}
+    if cache is not None:
+        cache = IdCache(cache)
+        results.update(cache.get(pmids))
+        pmids = [pmid for pmid in pmids if pmid not in results]
+        print('cached pmids', len(results))
+
+    session = http_session(workers)
+    rate_limiter = RateLimiter(rate)
+    chunks = [pmids[i: i + 200] for i in range(0, len(pmids), 200)]
+    with ThreadPoolExecutor(workers) as executor:
+        for rst in tqdm.tqdm(executor.map(lambda c: get_pmc_from_pmid(c, session, rate_limiter), chunks),
+                             total=len(chunks)):
+            results.update(rst)
+            if cache is not None:
+                cache.put(rst)
+    if cache is not None:
+        cache.close()
+
     data = []
-    for i in tqdm.tqdm(range(0, len(pmids), 200)):
-        results = get_pmc_from_pmid(pmids[i: i + 200])
-        for k, v in results.items():
-            x = {
-                'pmid': k,
-                'pmcid': v['pmcid'],
-                'doi': v['doi'],
-                'title': litcovid_data[k]['title'],
-                'journal': litcovid_data[k]['journal'],
-            }
-            data.append(x)
+    for k, v in results.items():
+        x = {
+            'pmid': k,
+            'pmcid': v['pmcid'],
+            'doi': v['doi'],
+            'title': litcovid_data[k]['title'],
+            'journal': litcovid_data[k]['journal'],
+        }
+        data.append(x)
 
     new_df = pd.DataFrame(data)
     if history is not None:
         new_df = pd.concat([history_df, new_df], axis=0)
     new_df.sort_values(by='pmid', inplace=True)
-    new_df.to_csv(dest, index=False)
+    write_table(new_df, dest)
 
 
 if __name__ == '__main__':
     args = docopt.docopt(__doc__)
-    get_pmc_from_pmid_f(Path(args['-i']), Path(args['-o']), args['-l'])
+    get_pmc_from_pmid_f(Path(args['-i']), Path(args['-o']), args['-l'],
+                        cache=args['--cache'],
+                        workers=int(args['--workers']),
+                        rate=float(args['--rate']))
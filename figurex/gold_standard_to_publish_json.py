@@ -1,62 +1,80 @@
 """
 Usage:
-    script.py -i SOURCE -o DEST
+    script.py [options] -i SOURCE -o DEST
 
 Options:
     -i <file>       gold standard file
-    -o <file>       released file
+    -o <file>       released file, written as JSON Lines if it ends with .jsonl
+    --compact       Do not indent the JSON file
 """
-import json
-import re
 from pathlib import Path
 
 import docopt
-import pandas as pd
 import tqdm
 from PIL import Image
 
+from figurex.utils import json_writer, read_table
 
-def gold_to_publish(src, dst, drop_nature=True):
-    df = pd.read_csv(src, dtype={'insert_time': str})
-    if drop_nature:
-        df = df[df['label'] != 'nature']
 
-    figures = {}
-    for _, row in tqdm.tqdm(df.iterrows(), total=len(df)):
-        pmc = row['pmcid']
-        figure_url = row['figure url']
-        url = f'https://www.ncbi.nlm.nih.gov/pmc/articles/{pmc}/bin/{figure_url}'
-        if url not in figures:
-            figures[url] = {
+def iter_figures(df):
+    """
+    Args:
+        df: gold standard rows, sorted by figure
+
+    Yields:
+        Dict: each figure, with the boxes of its sub-figures or the label of the whole figure
+    """
+    pmcids = df['pmcid'].astype(str)
+    urls = 'https://www.ncbi.nlm.nih.gov/pmc/articles/' + pmcids + '/bin/' + df['figure url'].astype(str)
+    boxes = df['subfigure filename'].str.extract(r'(\d+)x(\d+)_(\d+)x(\d+)')
+    rows = zip(df['pmcid'], urls, df['insert_time'], df['label'], boxes[0], boxes[1], boxes[2], boxes[3])
+
+    figure = None
+    for pmc, url, insert_time, label, xtl, ytl, xbr, ybr in tqdm.tqdm(rows, total=len(df)):
+        if figure is None or figure['url'] != url:
+            if figure is not None:
+                yield figure
+            figure = {
                 'pmcid': pmc,
                 'url': url,
-                'insert_time': row['insert_time']
+                'insert_time': insert_time
             }
-        figure = figures[url]
-
-        subfigure_filename = row['subfigure filename']
-        m = re.search(r'(\d+)x(\d+)_(\d+)x(\d+)', subfigure_filename)
-        if m:
+        if isinstance(xtl, str):
             if 'box' not in figure:
                 figure['box'] = []
             figure['box'].append({
-                'xtl': int(m.group(1)),
-                'ytl': int(m.group(2)),
-                'xbr': int(m.group(3)),
-                'ybr': int(m.group(4)),
-                'label': row['label']
+                'xtl': int(xtl),
+                'ytl': int(ytl),
+                'xbr': int(xbr),
+                'ybr': int(ybr),
+                'label': label
             })
         else:
             if 'box' not in figure:
-                figure['label'] = row['label']
+                figure['label'] = label
+    if figure is not None:
+        yield figure
+
+
+def gold_to_publish(src, dst, drop_nature=True, indent=2):
+    """
+    Writes each figure to dst as soon as all its rows are read. The rows are sorted by figure first, so that the
+    figures need not be held in memory.
+    """
+    df = read_table(src, columns=['pmcid', 'figure url', 'subfigure filename', 'label', 'insert_time'],
+                    dtype={'insert_time': str})
+    if drop_nature:
+        df = df[df['label'] != 'nature']
+    df = df.sort_values(['pmcid', 'figure url'], kind='mergesort')
 
-    figures = sorted(figures.values(), key=lambda x: (x['pmcid'], x['url']))
-    with open(dst, 'w') as fp:
-        json.dump(figures, fp, indent=2)
+    with json_writer(dst, indent=indent) as writer:
+        for figure in iter_figures(df):
+            writer.write(figure)
 
 
 if __name__ == '__main__':
     args = docopt.docopt(__doc__)
     gold_to_publish(src=Path(args['-i']),
-                    dst=Path(args['-o']))
+                    dst=Path(args['-o']),
+                    indent=None if args['--compact'] else 2)
 
@@ -0,0 +1,310 @@
+"""
+Runs the stages of the pipeline as a DAG, and tracks the state of each PMCID in each stage, so that a rerun only
+processes the new PMCIDs and the ones that failed.
+
+    pmc -> bioc -> figure_url -> figures -> split -> classify -> text
+       \\-> medline
+
+Usage:
+    script.py [options] -i SOURCE -d DATA_DIR -m SEPARATOR_MODEL -c CLASSIFIER_MODEL --email EMAIL --api-key API_KEY
+
+Options:
+    -i <file>           LitCovid file
+    -d <dir>            Data folder, with the tables, the images and the state of the pipeline
+    -m <file>           separator model path
+    -c <file>           classifier model path
+    --email <str>       E-utils email
+    --api-key <str>     E-utils API key
+    --format <str>      Format of the tables: csv, parquet or feather [default: csv]
+    --workers <int>     Number of stages run concurrently [default: 2]
+"""
+
+import collections
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+import docopt
+import pandas as pd
+from Bio import Entrez
+
+from figurex.classify_cxr_ct import detect_normal_cxr_ct_streaming
+from figurex.get_bioc import get_bioc_f
+from figurex.get_figure_text import get_figure_text
+from figurex.get_figure_url import get_figure_caption
+from figurex.get_figures import get_figures
+from figurex.get_medline import get_medline_file
+from figurex.get_pmc_from_pubmed import get_pmc_from_pmid_f
+from figurex.split_figures import split_figure_f
+from figurex.utils import Manifest, json_writer, read_table, write_table
+
+# stage -> the stages it depends on
+STAGES = collections.OrderedDict([
+    ('pmc', []),
+    ('bioc', ['pmc']),
+    ('medline', ['pmc']),
+    ('figure_url', ['bioc']),
+    ('figures', ['figure_url']),
+    ('split', ['figures']),
+    ('classify', ['split']),
+    ('text', ['classify']),
+])
+DONE = 'done'
+FAILED = 'failed'
+
+
+class PipelineState:
+    """Status of each PMCID in each stage, shared by the threads running the stages."""
+
+    def __init__(self, pathname):
+        self.conn = sqlite3.connect(str(pathname), check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS items (stage TEXT, pmcid TEXT, status TEXT, error TEXT, '
+                              'time TEXT, PRIMARY KEY (stage, pmcid))')
+
+    def status(self, stage):
+        with self.lock:
+            cursor = self.conn.execute('SELECT pmcid, status FROM items WHERE stage = ?', (stage,))
+            return dict(cursor.fetchall())
+
+    def update(self, stage, results):
+        """
+        Args:
+            results: pmcid -> (status, error)
+        """
+        now = time.strftime('%Y-%m-%dT%H:%M:%S')
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?)',
+                                  [(stage, k, status, error, now) for k, (status, error) in results.items()])
+
+    def close(self):
+        self.conn.close()
+
+
+class Pipeline:
+    def __init__(self, source, data_dir, separator_pathname, classifier_pathname, fmt='csv'):
+        self.source = source
+        self.data_dir = data_dir
+        self.separator_pathname = separator_pathname
+        self.classifier_pathname = classifier_pathname
+        self.fmt = fmt
+        self.bioc_dir = data_dir / 'bioc'
+        self.medline_dir = data_dir / 'medline'
+        self.figure_dir = data_dir / 'figures'
+        self.subfigure_dir = data_dir / 'subfigures'
+        self.subfigure_json_dir = data_dir / 'subfigures_json'
+        # inputs and outputs of the current run of each stage
+        self.work_dir = data_dir / 'work'
+        for d in (self.bioc_dir, self.medline_dir, self.figure_dir, self.subfigure_dir, self.subfigure_json_dir,
+                  self.work_dir):
+            d.mkdir(parents=True, exist_ok=True)
+        self.state = PipelineState(data_dir / 'pipeline.db')
+        # items of the bioc, medline, figures and split stages, shared by their scripts
+        self.manifest = data_dir / 'manifest.db'
+
+    def table(self, name):
+        return self.data_dir / f'{name}.{self.fmt}'
+
+    def pmcids(self):
+        if not self.table('pmc').exists():
+            return []
+        return list(read_table(self.table('pmc'), columns=['pmcid'], dtype=str)['pmcid'].dropna().unique())
+
+    def pending(self, stage):
+        """PMCIDs done in all the stages this stage depends on, and not done in this stage."""
+        deps = [self.state.status(dep) for dep in STAGES[stage]]
+        status = self.state.status(stage)
+        return [p for p in self.pmcids() if all(d.get(p) == DONE for d in deps) and status.get(p) != DONE]
+
+    def run(self, workers=2):
+        """
+        Runs each stage as soon as the stages it depends on are finished. A stage that raises, e.g., because a table
+        cannot be read, leaves the state of its items as it was, and the stages depending on it are skipped.
+        """
+        finished = set()
+        failed = set()
+        running = {}
+        with ThreadPoolExecutor(workers) as executor:
+            while len(finished) < len(STAGES):
+                for stage, deps in STAGES.items():
+                    if stage in finished or stage in running.values() or not all(d in finished for d in deps):
+                        continue
+                    if any(d in failed for d in deps):
+                        print('%s : skipped, %s failed' % (stage, ', '.join(d for d in deps if d in failed)))
+                        finished.add(stage)
+                        failed.add(stage)
+                    else:
+                        running[executor.submit(self.run_stage, stage)] = stage
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    finished.add(stage)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print('%s : failed, %r' % (stage, e))
+                        failed.add(stage)
+        self.state.close()
+
+    def run_stage(self, stage):
+        if stage == 'pmc':
+            try:
+                self.run_pmc()
+            except Exception as e:
+                # the other stages go on with the pmcids resolved before
+                print('%s : failed, %r' % (stage, e))
+            return
+        pmcids = self.pending(stage)
+        print('%s : %d pmcids to process' % (stage, len(pmcids)))
+        if not pmcids:
+            return
+        try:
+            results = getattr(self, f'run_{stage}')(pmcids)
+        except Exception as e:
+            # a failed stage fails its items, and the independent stages go on
+            print('%s : failed, %r' % (stage, e))
+            results = {p: (FAILED, repr(e)) for p in pmcids}
+        self.state.update(stage, results)
+        cnt = collections.Counter(status for status, _ in results.values())
+        for k, v in cnt.most_common():
+            print(stage, k, ':', v)
+
+    def _input(self, stage, table, pmcids):
+        """Writes the rows of table for pmcids, as the input of the stage."""
+        df = read_table(self.table(table)) if self.table(table).exists() else pd.DataFrame(columns=['pmcid'])
+        df = df[df['pmcid'].astype(str).isin(set(pmcids))]
+        src = self.work_dir / f'{stage}.input.csv'
+        write_table(df, src)
+        return df, src
+
+    def _merge(self, delta, table, pmcids):
+        """Replaces the rows of pmcids in table with the ones in delta."""
+        df = read_table(delta, dtype={'pmcid': str})
+        df = df[df['pmcid'].isin(set(pmcids))]
+        if self.table(table).exists():
+            history = read_table(self.table(table))
+            df = pd.concat([history[~history['pmcid'].astype(str).isin(set(pmcids))], df], axis=0)
+        write_table(df, self.table(table))
+        os.remove(delta)
+
+    def _manifest_results(self, stage, pmcids, error, items=None):
+        """
+        Results of a stage whose items are in the manifest: a PMCID is done if all its items are OK or MISSING.
+
+        Args:
+            items: DataFrame of the pmcid and the "figure filename" of the items, if they are not the PMCIDs
+        """
+        manifest = Manifest(self.manifest)
+        status = manifest.status(stage)
+        manifest.close()
+        if items is None:
+            failed = {p for p in pmcids if status.get(p) not in (Manifest.OK, Manifest.MISSING)}
+        else:
+            done = items['figure filename'].map(status).isin([Manifest.OK, Manifest.MISSING])
+            failed = set(items.loc[~done, 'pmcid'])
+        return {p: (FAILED, error) if p in failed else (DONE, None) for p in pmcids}
+
+    def run_pmc(self):
+        history = self.table('pmc') if self.table('pmc').exists() else None
+        get_pmc_from_pmid_f(self.source, self.table('pmc'), history, cache=self.work_dir / 'pmc.cache')
+        status = self.state.status('pmc')
+        self.state.update('pmc', {p: (DONE, None) for p in self.pmcids() if p not in status})
+
+    def run_bioc(self, pmcids):
+        _, src = self._input('bioc', 'pmc', pmcids)
+        get_bioc_f(src, self.bioc_dir, manifest=self.manifest)
+        # an article without BioC is final
+        return self._manifest_results('bioc', pmcids, 'no BioC file')
+
+    def run_medline(self, pmcids):
+        _, src = self._input('medline', 'pmc', pmcids)
+        get_medline_file(src, self.medline_dir, manifest=self.manifest)
+        return self._manifest_results('medline', pmcids, 'no Medline record')
+
+    def run_figure_url(self, pmcids):
+        _, src = self._input('figure_url', 'pmc', pmcids)
+        delta = self.work_dir / 'figure_url.output.csv'
+        get_figure_caption(src, delta, self.bioc_dir, overwrite=True)
+        self._merge(delta, 'figure_url', pmcids)
+        return {p: (DONE, None) for p in pmcids}
+
+    def run_figures(self, pmcids):
+        df, src = self._input('figures', 'figure_url', pmcids)
+        if len(df) == 0:
+            return {p: (DONE, None) for p in pmcids}
+        delta = self.work_dir / 'figures.output.csv'
+        get_figures(src, delta, self.figure_dir, manifest=self.manifest)
+        figures = read_table(delta, columns=['pmcid', 'figure filename'], dtype=str)
+        self._merge(delta, 'figures', pmcids)
+        # a figure that cannot be downloaded is final
+        return self._manifest_results('figures', pmcids, 'figures not downloaded', figures)
+
+    def run_split(self, pmcids):
+        df, src = self._input('split', 'figures', pmcids)
+        if len(df) == 0:
+            return {p: (DONE, None) for p in pmcids}
+        delta = self.work_dir / 'split.output.csv'
+        split_figure_f(src, delta, self.figure_dir, self.subfigure_dir, self.subfigure_json_dir,
+                       model_pathname=self.separator_pathname, manifest=self.manifest)
+        self._merge(delta, 'subfigures', pmcids)
+        # only the downloaded figures are split
+        figures = df[['pmcid', 'figure filename']].astype(str)
+        manifest = Manifest(self.manifest)
+        downloaded = manifest.status('figures')
+        manifest.close()
+        figures = figures[figures['figure filename'].map(downloaded).eq(Manifest.OK)]
+        return self._manifest_results('split', pmcids, 'figures not split', figures)
+
+    def run_classify(self, pmcids):
+        df, src = self._input('classify', 'subfigures', pmcids)
+        if len(df) == 0:
+            return {p: (DONE, None) for p in pmcids}
+        # the predictions of an interrupted run are kept, and not predicted again
+        delta = self.work_dir / 'classify.output.csv'
+        detect_normal_cxr_ct_streaming(self.classifier_pathname, src, delta, self.subfigure_dir,
+                                       x_col='subfigure filename', cache=self.work_dir / 'predictions.cache')
+        self._merge(delta, 'predictions', pmcids)
+        return {p: (DONE, None) for p in pmcids}
+
+    def run_text(self, pmcids):
+        df, _ = self._input('text', 'predictions', pmcids)
+        # one figure per article and figure url, labeled by the prediction of any of its ct or cxr sub-figures
+        df = df[df['prediction'].isin(['ct', 'cxr'])].drop_duplicates(['pmcid', 'figure url'])
+        if len(df) == 0:
+            return {p: (DONE, None) for p in pmcids}
+        src = self.work_dir / 'text.input.csv'
+        write_table(df.assign(label=df['prediction']), src)
+        delta = self.work_dir / 'text.output.jsonl'
+        get_figure_text(src, delta, self.bioc_dir)
+
+        dest = self.data_dir / 'text.jsonl'
+        pmcids = set(pmcids)
+        with json_writer(dest) as writer:
+            if dest.exists():
+                with open(dest, encoding='utf8') as fp:
+                    for line in fp:
+                        figure = json.loads(line)
+                        if figure['pmcid'] not in pmcids:
+                            writer.write(figure)
+            with open(delta, encoding='utf8') as fp:
+                for line in fp:
+                    writer.write(json.loads(line))
+        os.remove(delta)
+        return {p: (DONE, None) for p in pmcids}
+
+
+if __name__ == '__main__':
+    args = docopt.docopt(__doc__)
+    Entrez.email = args['--email']
+    Entrez.api_key = args['--api-key']
+    pipeline = Pipeline(source=Path(args['-i']),
+                        data_dir=Path(args['-d']),
+                        separator_pathname=Path(args['-m']),
+                        classifier_pathname=Path(args['-c']),
+                        fmt=args['--format'])
+    pipeline.run(workers=int(args['--workers']))
@@ -0,0 +1,187 @@
+"""
+Usage:
+    script.py [options] -m MODEL_FILE
+
+Options:
+    -m <file>               model path
+    --host <str>            Host to listen on [default: 127.0.0.1]
+    --port <int>            Port to listen on [default: 8501]
+    --batch-size <int>      Maximum number of images per batch [default: 64]
+    --max-latency <float>   Maximum seconds an image waits for its batch to fill up [default: 0.05]
+    --workers <int>         Number of image decoding threads [default: 4]
+"""
+
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import docopt
+import numpy as np
+import requests
+import tensorflow as tf
+
+from figurex.figure_separator import FigureSeparator, load_batch
+
+
+class DynamicBatcher:
+    """
+    Coalesces the images submitted by concurrent requests into batches for a FigureSeparator. A batch is run as soon as
+    it is full, or when its oldest image has waited max_latency seconds.
+    """
+
+    def __init__(self, separator, sess, batch_size=64, max_latency=0.05, workers=4):
+        self.separator = separator
+        self.sess = sess
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.executor = ThreadPoolExecutor(workers)
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image):
+        """
+        Args:
+            image: file path to the image file, or the encoded image bytes
+
+        Returns:
+            Future: the sub-figures of the image, as returned by `FigureSeparator.extract_sess`
+        """
+        future = Future()
+        self.requests.put((image, future))
+        return future
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+        self.executor.shutdown()
+
+    def _next_batch(self):
+        item = self.requests.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                self.requests.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                images, inputs = load_batch([image for image, _ in batch], self.executor, keep_images=False)
+                results = self.separator.extract_loaded(self.sess, images, inputs)
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result['sub_figures'])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+
+
+def make_handler(batcher):
+    class SeparatorHandler(BaseHTTPRequestHandler):
+        """
+        POST /extract with a JSON body {"paths": [...]} returns {"sub_figures": [...]} with the sub-figures of each
+        image. POST /extract with the encoded image as body returns {"sub_figures": ...} for that image.
+        """
+
+        def do_POST(self):
+            if self.path != '/extract':
+                self.send_error(404)
+                return
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            try:
+                if self.headers.get('Content-Type') == 'application/json':
+                    futures = [batcher.submit(path) for path in json.loads(body)['paths']]
+                    response = {'sub_figures': [f.result() for f in futures]}
+                else:
+                    response = {'sub_figures': batcher.submit(body).result()}
+            except Exception as e:
+                self.send_error(500, str(e))
+                return
+            data = json.dumps(response).encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return SeparatorHandler
+
+
+class SeparatorClient:
+    """
+    Client of the separator server. `extract` returns the same sub-figures as `FigureSeparator.extract_batch`.
+    """
+
+    def __init__(self, address, timeout=600):
+        """
+        Args:
+            address: server address, e.g., http://127.0.0.1:8501
+            timeout: seconds to wait for a response
+        """
+        self.address = address.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def extract(self, img_paths):
+        """The image paths must be readable by the server."""
+        paths = [str(Path(p).resolve()) for p in img_paths]
+        response = self.session.post(f'{self.address}/extract', json={'paths': paths}, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()['sub_figures']
+
+    def extract_bytes(self, data):
+        response = self.session.post(f'{self.address}/extract', data=data, timeout=self.timeout,
+                                     headers={'Content-Type': 'application/octet-stream'})
+        response.raise_for_status()
+        return response.json()['sub_figures']
+
+
+def serve(model_pathname, host='127.0.0.1', port=8501, batch_size=64, max_latency=0.05, workers=4):
+    tf.compat.v1.disable_eager_execution()
+    separator = FigureSeparator(str(model_pathname))
+
+    with tf.compat.v1.Session(graph=separator.graph) as sess:
+        # warm up the session before accepting requests
+        separator.extract_loaded(sess, [{'shape': None}], np.zeros((1, 544, 544, 3), dtype=np.float32))
+        batcher = DynamicBatcher(separator, sess, batch_size, max_latency, workers)
+        server = ThreadingHTTPServer((host, port), make_handler(batcher))
+        print('Serving on http://%s:%d' % (host, port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            batcher.close()
+
+
+if __name__ == '__main__':
+    args = docopt.docopt(__doc__)
+    serve(model_pathname=Path(args['-m']),
+          host=args['--host'],
+          port=int(args['--port']),
+          batch_size=int(args['--batch-size']),
+          max_latency=float(args['--max-latency']),
+          workers=int(args['--workers']))
@@ -0,0 +1,157 @@
+"""
+Usage:
+    script.py [options] -i SOURCE -o DEST -f FIGURE_DIR -d SUBFIGURE_IMAGE_DIR -s SUBFIGURE_DIR -m MODEL_FILE -c CLASSIFIER_FILE
+
+Options:
+    -i <file>       Figure csv file
+    -o <file>       Prediction csv file
+    -f <dir>        figure store dir
+    -d <dir>        subfigure store or shard dir
+    -s <dir>        subfigure json dir
+    -m <file>       separator model path
+    -c <file>       classifier model path
+    --save-all          Save all sub-figures, not only the ct and cxr ones
+    --batch-size <int>  Number of figures per separator batch [default: 64]
+    --classifier-batch-size <int>  Number of sub-figures per classifier batch [default: 32]
+    --workers <int>     Number of image decoding threads [default: 4]
+    --manifest <file>   Manifest of the figures, FIGURE_DIR/.manifest.db by default
+"""
+
+import collections
+from pathlib import Path
+
+import docopt
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+import tqdm
+from PIL import Image
+from keras.applications import densenet
+from keras.models import load_model
+
+from figurex.classify_cxr_ct import CLASSES, image_to_array, write_predictions
+from figurex.figure_separator import BatchLoader, FigureSeparator
+from figurex.figure_store import FigureStore, open_store
+from figurex.split_figures import save_subfigures, subfigure_boxes, subfigure_filename
+from figurex.utils import MANIFEST_FILE, Manifest, append_table, read_table
+
+
+def crop_figure(src, imgcv, subfigures, min_width=214, min_height=214):
+    """
+    Crops the sub-figures of a decoded figure in memory, the same way `split_figures.split_figure` does on disk.
+
+    Args:
+        src: file name of the figure, as a Path
+
+    Returns:
+        List: (subfigure filename, RGB image array) of the sub-figures, followed by the whole figure
+    """
+    rgb = imgcv[:, :, ::-1]
+    crops = [(subfigure_filename(src, (left, top, right, bottom)), rgb[top:bottom, left:right])
+             for left, top, right, bottom in subfigure_boxes(subfigures, min_width, min_height)]
+    crops.append((src.name, rgb))
+    return crops
+
+
+def split_classify_f(src, dest, src_image_dir, dest_image_dir, dest_json_dir, separator_pathname,
+                     classifier_pathname, batch_size=64, classifier_batch_size=32, workers=4, save_all=False,
+                     manifest=None):
+    """
+    Splits the figures and classifies the sub-figures in one pass. The sub-figures are cropped from the figure decoded
+    for the separator and fed to the classifier in memory, and only the ct and cxr ones (or all with save_all) are
+    written to dest_image_dir. Figures already in dest are skipped, so an interrupted run resumes.
+    """
+    figure_df = read_table(src)
+    columns = list(figure_df.columns) + ['subfigure filename', 'prediction'] + CLASSES
+    cnt = collections.Counter()
+
+    if dest.exists():
+        done = set(read_table(dest, columns=['figure filename'], dtype=str)['figure filename'].astype(str))
+        figure_df = figure_df[~figure_df['figure filename'].astype(str).isin(done)]
+    else:
+        append_table(pd.DataFrame(columns=columns), dest)
+
+    src_store = FigureStore(src_image_dir)
+    dest_store = open_store(dest_image_dir)
+    figure_stat = src_store.stat(figure_df['figure filename'].astype(str))
+    manifest = Manifest(manifest if manifest is not None else src_image_dir / MANIFEST_FILE)
+    manifest.adopt_store('figures', src_store, figure_df['figure filename'].astype(str))
+    downloaded = manifest.status('figures')
+    manifest.close()
+    empty = figure_df['figure filename'].astype(str).map(downloaded).ne(Manifest.OK) \
+        | ~figure_df['figure filename'].astype(str).isin(figure_stat)
+    cnt['empty figure'] = int(empty.sum())
+    figure_df = figure_df[~empty].reset_index(drop=True)
+    names = list(figure_df['figure filename'].astype(str))
+    figure_paths = src_store.paths(names)
+    srcs = [figure_paths[n] for n in names]
+
+    tf.compat.v1.disable_eager_execution()
+    separator = FigureSeparator(str(separator_pathname))
+    classifier = load_model(classifier_pathname)
+
+    # the separator session is not made the default one, in which keras would run the classifier of the global graph
+    sess = tf.compat.v1.Session(graph=separator.graph)
+    try:
+        loader = BatchLoader(srcs, batch_size=batch_size, workers=workers, keep_images=True)
+        offset = 0
+        for batch_srcs, batch, inputs, _ in tqdm.tqdm(loader, total=len(loader)):
+            batch_names = [Path(n) for n in names[offset: offset + len(batch_srcs)]]
+            results = separator.extract_loaded(sess, batch, inputs)
+            save_subfigures(batch_names, [result['sub_figures'] for result in results], dest_json_dir)
+
+            crops = []
+            for j, (figure_src, result) in enumerate(zip(batch_names, results)):
+                if result['imgcv'] is None:
+                    cnt['cannot read'] += 1
+                    continue
+                for filename, crop in crop_figure(figure_src, result['imgcv'], result['sub_figures']):
+                    crops.append((offset + j, figure_src, filename, crop))
+            offset += len(batch_srcs)
+
+            if not crops:
+                continue
+            y_score = []
+            for i in range(0, len(crops), classifier_batch_size):
+                x = np.stack([image_to_array(Image.fromarray(np.ascontiguousarray(c[3])))
+                              for c in crops[i: i + classifier_batch_size]])
+                y_score.append(np.asarray(classifier.predict_on_batch(densenet.preprocess_input(x))))
+            y_score = np.concatenate(y_score)
+
+            for (_, figure_src, filename, crop), label in zip(crops, np.argmax(y_score, axis=1)):
+                cnt[CLASSES[label]] += 1
+                if (save_all or CLASSES[label] in ('ct', 'cxr')) and filename not in dest_store:
+                    if filename == figure_src.name:
+                        dest_store.put_file(filename, figure_paths[filename], sha1=figure_stat[filename][1])
+                    else:
+                        with dest_store.writer(filename) as fp:
+                            Image.fromarray(np.ascontiguousarray(crop)).save(
+                                fp, format=Image.registered_extensions()[figure_src.suffix.lower()])
+                    cnt['saved'] += 1
+
+            # all rows of a batch are written at once, so that a figure is either complete in dest or absent
+            rows = figure_df.iloc[[c[0] for c in crops]].assign(**{'subfigure filename': [c[2] for c in crops]})
+            write_predictions(dest, rows, y_score, columns)
+    finally:
+        sess.close()
+    src_store.close()
+    dest_store.close()
+
+    for k, v in cnt.most_common():
+        print(k, ':', v)
+
+
+if __name__ == '__main__':
+    args = docopt.docopt(__doc__)
+    split_classify_f(src=Path(args['-i']),
+                     dest=Path(args['-o']),
+                     src_image_dir=Path(args['-f']),
+                     dest_image_dir=Path(args['-d']),
+                     dest_json_dir=Path(args['-s']),
+                     separator_pathname=Path(args['-m']),
+                     classifier_pathname=Path(args['-c']),
+                     batch_size=int(args['--batch-size']),
+                     classifier_batch_size=int(args['--classifier-batch-size']),
+                     workers=int(args['--workers']),
+                     save_all=args['--save-all'],
+                     manifest=Path(args['--manifest']) if args['--manifest'] else None)
@@ -1,116 +1,242 @@
 """
 Usage:
-    script.py [options] -i SOURCE -o DEST -f FIGURE_DIR -s SUBFIGURE_DIR -m MODEL_FILE
+    script.py [options] -i SOURCE -o DEST -f FIGURE_DIR -s SUBFIGURE_DIR (-m MODEL_FILE | --server URL)
 
 Options:
     -i <file>       Figure csv file
     -o <file>       Subfigure csv file
-    -f <dir>        figure dir
-    -s <dir>        subfigure dir
+    -f <dir>        figure store dir, where the sub-figures are stored too
+    -s <dir>        subfigure json dir
     -m <file>       model path
+    --server <url>      Address of a running separator_server, used instead of loading the model
+    --workers <int>     Number of image decoding threads [default: 4]
+    --queue-size <int>  Number of batches decoded ahead of the inference [default: 2]
+    --manifest <file>   Manifest of the figures, FIGURE_DIR/.manifest.db by default
+    --shards <dir>      Write the sub-figures into tar shards in this folder instead of FIGURE_DIR
+    --shard-size <int>  Size of each shard in MB [default: 1024]
+    --reduced           Decode the JPEG figures at a reduced resolution for the separator, and at full resolution
+                        only the figures with sub-figures to crop
+    --crop-in-memory    Crop the sub-figures from the figures decoded for the separator instead of decoding them again.
+                        Keeps the full resolution figures of up to queue-size + 2 batches in memory
 """
 
 import collections
-import copy
 import json
-import shutil
+import time
 from pathlib import Path
 
 import docopt
-import pandas as pd
+import numpy as np
 import tensorflow as tf
 import tqdm
-from PIL import Image
+from PIL import Image, ImageOps
 
-from figurex.figure_separator import FigureSeparator
-from figurex.utils import is_file_empty
+from figurex.figure_separator import BatchLoader, FigureSeparator
+from figurex.figure_store import FigureStore, ShardStore, open_store
+from figurex.separator_server import SeparatorClient
+from figurex.utils import MANIFEST_FILE, Manifest, read_table, write_table
 
 
-def split_figure(src, subfigures, dest_dir, min_width=214, min_height=214):
+def subfigure_boxes(subfigures, min_width=214, min_height=214):
+    """
+    Returns:
+        List: the (left, top, right, bottom) boxes to crop. Empty if the figure has at most one sub-figure, otherwise
+            the sub-figures that are large enough.
+    """
+    if len(subfigures) <= 1:
+        return []
+    return [(s['x'], s['y'], s['x'] + s['w'], s['y'] + s['h']) for s in subfigures
+            if s['w'] >= min_width and s['h'] >= min_height]
+
+
+def subfigure_filename(src, box):
+    left, top, right, bottom = box
+    return f'{src.stem}_{left}x{top}_{right}x{bottom}{src.suffix}'
+
+
+def split_figure(name, src, subfigures, dest_store, min_width=214, min_height=214):
+    """
+    Args:
+        name: file name of the figure
+        src: path of the figure
+        dest_store: FigureStore or ShardStore of the sub-figures
+
+    Returns:
+        List: the file names of the sub-figures in dest_store
+    """
+    # the sub-figures are cropped from the oriented RGB figure, as cv2 decodes it for the separator
+    boxes = subfigure_boxes(subfigures, min_width, min_height)
+    filenames = [subfigure_filename(Path(name), box) for box in boxes]
+
+    # the figure is only decoded if some of its sub-figures are not stored yet
+    missing = [(filename, box) for filename, box in zip(filenames, boxes) if filename not in dest_store]
+    if missing:
+        # the format of each sub-figure is given by its extension, as when saving to a file name
+        image_format = Image.registered_extensions()[Path(name).suffix.lower()]
+        with Image.open(src) as im:
+            im = ImageOps.exif_transpose(im).convert('RGB')
+            for filename, box in missing:
+                subim = im.crop(box)
+                with dest_store.writer(filename) as fp:
+                    subim.save(fp, format=image_format)
+
+    return filenames
+
+
+def json_filename(figure_filename):
+    return f'{Path(figure_filename).stem}.json'
+
+
+def crop_subfigures(name, imgcv, subfigures, dest_store, min_width=214, min_height=214):
+    """
+    Same as `split_figure`, but crops the BGR image array already decoded by the separator instead of decoding the
+    figure again. cv2 applies the EXIF orientation and converts to 3 channels, so the sub-figures are the same.
+    """
     filenames = []
 
-    if len(subfigures) > 1:
-        im = Image.open(src)
-        for subfigure in subfigures:
-            if subfigure['w'] < min_width or subfigure['h'] < min_height:
-                continue
-            left = subfigure['x']
-            top = subfigure['y']
-            right = left + subfigure['w']
-            bottom = top + subfigure['h']
-            dst = dest_dir / f'{src.stem}_{left}x{top}_{right}x{bottom}{src.suffix}'
-            if not dst.exists():
-                subim = im.crop((left, top, right, bottom))
-                subim.save(dst)
-            filenames.append(dst)
+    boxes = subfigure_boxes(subfigures, min_width, min_height)
+    if boxes and imgcv is not None:
+        image_format = Image.registered_extensions()[Path(name).suffix.lower()]
+        for box in boxes:
+            filename = subfigure_filename(Path(name), box)
+            if filename not in dest_store:
+                left, top, right, bottom = box
+                subim = Image.fromarray(np.ascontiguousarray(imgcv[top:bottom, left:right, ::-1]))
+                with dest_store.writer(filename) as fp:
+                    subim.save(fp, format=image_format)
+            filenames.append(filename)
 
     return filenames
 
 
-def split_figure_f(src, dest, src_image_dir, dest_image_dir, dest_json_dir, model_pathname, batch_size=64):
-    figure_df = pd.read_csv(src)
-    data = []
+def save_subfigures(srcs, sub_figures, dest_json_dir):
+    """
+    Args:
+        srcs: file names of the figures
+    """
+    assert len(sub_figures) == len(srcs)
+    for src, subfigures in zip(srcs, sub_figures):
+        json_dst = dest_json_dir / json_filename(src)
+        with open(json_dst, 'w') as fp:
+            json.dump(subfigures, fp)
+
+
+def subfigure_rows(figure_df, filenames):
+    """
+    Args:
+        figure_df: figure table
+        filenames: for each figure, the file names of its sub-figures
+
+    Returns:
+        DataFrame: one row per sub-figure, the row of its figure with the sub-figure file name
+    """
+    df = figure_df.assign(**{'subfigure filename': filenames}).explode('subfigure filename')
+    return df[df['subfigure filename'].notna()]
+
+
+def split_figure_f(src, dest, src_image_dir, dest_image_dir, dest_json_dir, model_pathname=None, batch_size=64,
+                   workers=4, queue_size=2, server=None, manifest=None, shards=False, shard_size=1 << 30,
+                   reduced=False, crop_in_memory=False):
+    """
+    Splits the downloaded figures, i.e., the ones OK in the "figures" stage of the manifest, that are not yet OK in its
+    "split" stage. With shards, or if dest_image_dir already has shards, the sub-figures are packed in tar shards.
+
+    With reduced, the JPEG figures are decoded at the smallest scale that is still at least the separator input. Only
+    the figures with sub-figures large enough to crop are then decoded again at full resolution.
+
+    With crop_in_memory, the sub-figures are cropped from the figures decoded for the separator, so each figure is
+    decoded once. The loader then keeps the full resolution figures of every loaded batch, i.e., up to
+    (queue_size + 2) * batch_size figures, e.g. about 1.1GB per batch of 64 figures of 3000x2000 pixels.
+    """
+    if reduced and crop_in_memory:
+        raise ValueError('the full resolution figures are not decoded with reduced')
+
+    figure_df = read_table(src)
     cnt = collections.Counter()
 
-    tf.compat.v1.disable_eager_execution()
-    separator = FigureSeparator(str(model_pathname))
-
-    with tf.compat.v1.Session(graph=separator.graph) as sess:
-        needs_to_split = []
-
-        def split_and_save():
-            results = separator.extract_batch(sess, needs_to_split)
-            assert len(results) == len(needs_to_split)
-            for src, result in zip(needs_to_split, results):
-                subfigures = result['sub_figures']
-                json_dst = dest_json_dir / f'{src.stem}.json'
-                with open(json_dst, 'w') as fp:
-                    json.dump(subfigures, fp)
-
-        for filename in tqdm.tqdm(figure_df['figure filename'], total=len(figure_df), desc='Check subfigures'):
-            src = src_image_dir / filename
-            if is_file_empty(src):
-                cnt['empty figure'] += 1
-                continue
-            json_dst = dest_json_dir / f'{src.stem}.json'
-            if not json_dst.exists():
-                needs_to_split.append(src)
-
-            if len(needs_to_split) >= batch_size:
-                split_and_save()
-                needs_to_split = []
-        if len(needs_to_split) > 0:
-            split_and_save()
-
-    for _, row in tqdm.tqdm(figure_df.iterrows(), total=len(figure_df), desc='Write sub figures'):
-        src = src_image_dir / row['figure filename']
-        json_dst = dest_json_dir / f'{src.stem}.json'
-        if not json_dst.exists():
+    figure_filenames = list(figure_df['figure filename'].astype(str))
+    src_store = FigureStore(src_image_dir)
+    dest_store = ShardStore(dest_image_dir, shard_size) if shards else open_store(dest_image_dir)
+    figure_stat = src_store.stat(figure_filenames)
+    figure_paths = src_store.paths(figure_filenames)
+
+    manifest = Manifest(manifest if manifest is not None else src_image_dir / MANIFEST_FILE)
+    manifest.adopt_store('figures', src_store, figure_filenames)
+    manifest.adopt('split', dest_json_dir, figure_filenames, filename=json_filename)
+    downloaded = manifest.status('figures')
+    split = manifest.status('split')
+
+    needs_to_split = []
+    for filename in figure_filenames:
+        if downloaded.get(filename) != Manifest.OK or filename not in figure_paths:
+            cnt['empty figure'] += 1
+        elif split.get(filename) != Manifest.OK:
+            needs_to_split.append(filename)
+
+    timing = collections.Counter()
+    if server is not None:
+        client = SeparatorClient(server)
+        for i in tqdm.tqdm(range(0, len(needs_to_split), batch_size), desc='Split figures'):
+            names = needs_to_split[i: i + batch_size]
+            start = time.perf_counter()
+            save_subfigures(names, client.extract([figure_paths[n] for n in names]), dest_json_dir)
+            manifest.put('split', [{'item': n, 'status': Manifest.OK} for n in names])
+            timing['server'] += time.perf_counter() - start
+    else:
+        tf.compat.v1.disable_eager_execution()
+        separator = FigureSeparator(str(model_pathname))
+
+        with tf.compat.v1.Session(graph=separator.graph) as sess:
+            loader = BatchLoader([figure_paths[n] for n in needs_to_split], batch_size=batch_size, workers=workers,
+                                 queue_size=queue_size, keep_images=crop_in_memory, reduced=reduced)
+            pbar = tqdm.tqdm(loader, total=len(loader), desc='Split figures')
+            offset = 0
+            for srcs, batch, inputs, decode_time in pbar:
+                # the batches are in order, and the paths of a deduplicated figure are shared by its names
+                names = needs_to_split[offset: offset + len(srcs)]
+                offset += len(srcs)
+                start = time.perf_counter()
+                results = separator.extract_loaded(sess, batch, inputs)
+                inference_time = time.perf_counter() - start
+                pbar.set_postfix(decode='%.2fs' % decode_time, inference='%.2fs' % inference_time)
+                timing['decode'] += decode_time
+                timing['inference'] += inference_time
+                save_subfigures(names, [result['sub_figures'] for result in results], dest_json_dir)
+                if crop_in_memory:
+                    start = time.perf_counter()
+                    for name, result in zip(names, results):
+                        crop_subfigures(name, result['imgcv'], result['sub_figures'], dest_store, 214, 214)
+                    timing['crop'] += time.perf_counter() - start
+                manifest.put('split', [{'item': n, 'status': Manifest.OK} for n in names])
+
+    split = manifest.status('split')
+    manifest.close()
+    for k, v in timing.items():
+        print('%s time : %.2fs' % (k, v))
+
+    filenames = []
+    for figure_filename in tqdm.tqdm(figure_filenames, total=len(figure_df), desc='Write sub figures'):
+        if split.get(figure_filename) != Manifest.OK or figure_filename not in figure_paths:
+            filenames.append([])
             continue
 
-        with open(json_dst) as fp:
+        src = figure_paths[figure_filename]
+        with open(dest_json_dir / json_filename(figure_filename)) as fp:
             subfigures = json.load(fp)
 
-        pathnames = split_figure(src, subfigures, dest_image_dir, 214, 214)
-        # subfigure
-        for pathname in pathnames:
-            x = copy.deepcopy(row)
-            x['subfigure filename'] = pathname.name
-            cnt['subfig'] += len(pathnames)
-            cnt['figure'] += 1
-            data.append(x)
-
-        # whole figure
-        pathname = dest_image_dir / src.name
-        if not pathname.exists():
-            shutil.copy(src, pathname)
-        x = copy.deepcopy(row)
-        x['subfigure filename'] = pathname.name
+        # subfigure, only decoded here if not cropped in memory
+        names = split_figure(figure_filename, src, subfigures, dest_store, 214, 214)
+        cnt['subfig'] += len(names)
+        # whole figure, stored once if the stores are the same
+        if figure_filename not in dest_store:
+            dest_store.put_file(figure_filename, src, sha1=figure_stat[figure_filename][1])
         cnt['figure'] += 1
-        data.append(x)
+        filenames.append(names + [figure_filename])
+    src_store.close()
+    dest_store.close()
 
-    df = pd.DataFrame(data)
-    df.to_csv(dest, index=False)
+    df = subfigure_rows(figure_df, filenames)
+    write_table(df, dest)
 
     for k, v in cnt.most_common():
         print(k, ':', v)
@@ -121,7 +247,15 @@ if __name__ == '__main__':
     split_figure_f(src=Path(args['-i']),
                    dest=Path(args['-o']),
                    src_image_dir=Path(args['-f']),
-                   dest_image_dir=Path(args['-f']),
+                   dest_image_dir=Path(args['--shards']) if args['--shards'] else Path(args['-f']),
                    dest_json_dir=Path(args['-s']),
-                   model_pathname=Path(args['-m']))
+                   model_pathname=Path(args['-m']) if args['-m'] else None,
+                   server=args['--server'],
+                   workers=int(args['--workers']),
+                   queue_size=int(args['--queue-size']),
+                   manifest=Path(args['--manifest']) if args['--manifest'] else None,
+                   shards=args['--shards'] is not None,
+                   shard_size=int(args['--shard-size']) << 20,
+                   reduced=args['--reduced'],
+                   crop_in_memory=args['--crop-in-memory'])
 
@@ -1,8 +1,323 @@
+import contextlib
+import hashlib
+import json
 import os
+import sqlite3
+import textwrap
+import threading
+import time
+from pathlib import Path
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+# status codes worth retrying: rate limited, or a transient server error
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# default manifest file, in the output folder of a stage
+MANIFEST_FILE = '.manifest.db'
+# suffixes of the columnar table formats, which need pyarrow
+PARQUET_SUFFIXES = {'.parquet', '.pq'}
+FEATHER_SUFFIXES = {'.feather', '.arrow'}
 
 
 def is_file_empty(pathanme):
     return os.path.exists(pathanme) and os.stat(pathanme).st_size == 0
 
 def is_file_not_empty(pathanme):
-    return os.path.exists(pathanme) and os.stat(pathanme).st_size != 0
\ No newline at end of file
+    return os.path.exists(pathanme) and os.stat(pathanme).st_size != 0
+
+
+def file_hash(pathname, chunk_size=1 << 20):
+    """SHA-1 of the content of a file, or of all files in a directory."""
+    h = hashlib.sha1()
+    pathnames = sorted(p for p in pathname.rglob('*') if p.is_file()) if pathname.is_dir() else [pathname]
+    for p in pathnames:
+        if pathname.is_dir():
+            h.update(str(p.relative_to(pathname)).encode('utf8'))
+        with open(p, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(chunk_size), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+class RateLimiter:
+    """Spaces out the calls of all threads sharing the limiter to at most `rate` per second."""
+
+    def __init__(self, rate):
+        self.interval = 1. / rate if rate else 0.
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def http_session(pool_size=10):
+    """A requests Session keeping up to `pool_size` connections alive per host."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_with_retry(session, url, rate_limiter=None, retries=5, backoff=1., timeout=60, **kwargs):
+    """
+    GET a url, retrying connection errors, timeouts, 429 and 5xx responses with exponential backoff. A Retry-After
+    header of a response takes precedence over the backoff.
+
+    Returns:
+        the last response, which may still be an error response
+    """
+    for attempt in range(retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.wait()
+        try:
+            response = session.get(url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+        else:
+            if response.status_code not in RETRY_STATUS or attempt == retries:
+                return response
+            retry_after = response.headers.get('Retry-After', '')
+            delay = float(retry_after) if retry_after.isdigit() else backoff * 2 ** attempt
+            response.close()
+        time.sleep(delay)
+
+
+@contextlib.contextmanager
+def atomic_write(pathname, mode='w', **kwargs):
+    """
+    Writes to a temporary file in the same directory, and renames it to pathname only if the block completes, so that
+    pathname is never left half-written.
+    """
+    pathname = str(pathname)
+    tmp = os.path.join(os.path.dirname(pathname),
+                       '.%s.%d.%d.tmp' % (os.path.basename(pathname), os.getpid(), threading.get_ident()))
+    try:
+        with open(tmp, mode, **kwargs) as fp:
+            yield fp
+        os.replace(tmp, pathname)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class JsonWriter:
+    """
+    Writes objects one at a time, as a JSON array or as JSON Lines. The JSON array is the same as `json.dump` of the
+    list of objects with the same indent.
+    """
+
+    def __init__(self, fp, jsonl=False, indent=None):
+        self.fp = fp
+        self.jsonl = jsonl
+        self.indent = indent
+        self.count = 0
+
+    def write(self, obj):
+        if self.jsonl:
+            self.fp.write(json.dumps(obj) + '\n')
+        elif self.indent is None:
+            self.fp.write(('[' if self.count == 0 else ', ') + json.dumps(obj))
+        else:
+            self.fp.write(('[' if self.count == 0 else ',') + '\n'
+                          + textwrap.indent(json.dumps(obj, indent=self.indent), ' ' * self.indent))
+        self.count += 1
+
+    def close(self):
+        if self.jsonl:
+            return
+        if self.count == 0:
+            self.fp.write('[]')
+        else:
+            self.fp.write(']' if self.indent is None else '\n]')
+
+
+@contextlib.contextmanager
+def json_writer(pathname, indent=2):
+    """
+    Opens a `JsonWriter` on pathname, writing JSON Lines if pathname ends with .jsonl. The file is written atomically.
+    """
+    with atomic_write(pathname, encoding='utf8') as fp:
+        writer = JsonWriter(fp, jsonl=str(pathname).endswith('.jsonl'), indent=indent)
+        yield writer
+        writer.close()
+
+
+def table_format(pathname):
+    """Returns 'parquet', 'feather' or 'csv', from the suffix of pathname."""
+    suffix = Path(pathname).suffix.lower()
+    if suffix in PARQUET_SUFFIXES:
+        return 'parquet'
+    if suffix in FEATHER_SUFFIXES:
+        return 'feather'
+    return 'csv'
+
+
+def read_table(pathname, columns=None, dtype=None, **kwargs):
+    """
+    Reads a table of the pipeline in the format given by its suffix: Parquet (a file, or a folder of parts written by
+    `append_table`), Arrow IPC (.feather or .arrow), or CSV.
+
+    Args:
+        pathname: table file
+        columns: only read these columns
+        dtype: column types of a CSV file. Parquet and Arrow files keep the types they were written with.
+        kwargs: passed to `pd.read_csv`
+    """
+    fmt = table_format(pathname)
+    if fmt == 'parquet':
+        return pd.read_parquet(pathname, columns=columns)
+    if fmt == 'feather':
+        return pd.read_feather(pathname, columns=columns)
+    return pd.read_csv(pathname, usecols=columns, dtype=dtype, **kwargs)
+
+
+def write_table(df, pathname):
+    """Writes a table atomically, in the format given by the suffix of pathname."""
+    fmt = table_format(pathname)
+    if fmt == 'parquet':
+        with atomic_write(pathname, 'wb') as fp:
+            df.to_parquet(fp, index=False)
+    elif fmt == 'feather':
+        with atomic_write(pathname, 'wb') as fp:
+            df.reset_index(drop=True).to_feather(fp)
+    else:
+        with atomic_write(pathname, 'w', encoding='utf8', newline='') as fp:
+            df.to_csv(fp, index=False)
+
+
+def append_table(df, pathname, columns=None):
+    """
+    Appends rows to a table. A CSV file gets its header when it is created. A Parquet table is a folder, to which each
+    call adds a part; nothing is written for no rows. All parts have the schema of the first one, in which the columns
+    without any value are strings, so that the folder reads as one table.
+    """
+    fmt = table_format(pathname)
+    if fmt == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if len(df) == 0:
+            return
+        df = df if columns is None else df[columns]
+        os.makedirs(pathname, exist_ok=True)
+        with os.scandir(pathname) as it:
+            n = sum(1 for entry in it if entry.name.endswith('.parquet'))
+        if n == 0:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            schema = pa.schema([pa.field(f.name, pa.string()) if pa.types.is_null(f.type) else f for f in table.schema],
+                               metadata=table.schema.metadata)
+            table = table.cast(schema)
+        else:
+            schema = pq.read_schema(os.path.join(pathname, 'part-%05d.parquet' % 0))
+            table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+        with atomic_write(os.path.join(pathname, 'part-%05d.parquet' % n), 'wb') as fp:
+            pq.write_table(table, fp)
+    elif fmt == 'feather':
+        raise ValueError('Cannot append to an Arrow IPC file: %s' % pathname)
+    else:
+        header = not is_file_not_empty(pathname)
+        with open(pathname, 'a', encoding='utf8', newline='') as fp:
+            df.to_csv(fp, header=header, index=False, columns=columns)
+
+
+class Manifest:
+    """
+    Status of the items of the stages, e.g., the PMCIDs of get_bioc or the figures of get_figures, with their size,
+    hash, error code and timestamps. A stage decides its work with one query instead of checking each file.
+
+    The statuses are OK, MISSING for items that do not exist upstream and are not requested again, and FAILED for
+    items to retry. The SQLite file is in WAL mode, so that concurrent stages and threads can share it.
+    """
+    OK = 'ok'
+    MISSING = 'missing'
+    FAILED = 'failed'
+    FIELDS = ['item', 'status', 'size', 'hash', 'code', 'error', 'created', 'updated']
+
+    def __init__(self, pathname):
+        self.conn = sqlite3.connect(str(pathname), timeout=60, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            with self.conn:
+                self.conn.execute('CREATE TABLE IF NOT EXISTS items (stage TEXT, item TEXT, status TEXT, '
+                                  'size INTEGER, hash TEXT, code INTEGER, error TEXT, created TEXT, updated TEXT, '
+                                  'PRIMARY KEY (stage, item))')
+
+    def close(self):
+        self.conn.close()
+
+    def get(self, stage):
+        """
+        Returns:
+            Dict: item -> its record, a dict of FIELDS, for all items of the stage
+        """
+        with self.lock:
+            cursor = self.conn.execute('SELECT %s FROM items WHERE stage = ?' % ', '.join(self.FIELDS), (stage,))
+            return {row[0]: dict(zip(self.FIELDS, row)) for row in cursor}
+
+    def status(self, stage):
+        """
+        Returns:
+            Dict: item -> status, for all items of the stage
+        """
+        with self.lock:
+            return dict(self.conn.execute('SELECT item, status FROM items WHERE stage = ?', (stage,)).fetchall())
+
+    def todo(self, stage, items, retry_missing=False):
+        """Returns the items, in order and without duplicates, that are not OK, or MISSING unless retry_missing."""
+        status = self.status(stage)
+        skip = {self.OK} if retry_missing else {self.OK, self.MISSING}
+        return [item for item in dict.fromkeys(items) if status.get(item) not in skip]
+
+    def put(self, stage, records):
+        """
+        Args:
+            records: dicts with the "item", its "status", and optionally its "size", "hash", "code" and "error"
+        """
+        now = time.strftime('%Y-%m-%dT%H:%M:%S')
+        rows = [(stage, r['item'], r['status'], r.get('size'), r.get('hash'), r.get('code'), r.get('error'), now, now)
+                for r in records]
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                                  'ON CONFLICT (stage, item) DO UPDATE SET status = excluded.status, '
+                                  'size = excluded.size, hash = excluded.hash, code = excluded.code, '
+                                  'error = excluded.error, updated = excluded.updated', rows)
+
+    def adopt(self, stage, dirname, items, filename=str):
+        """
+        Registers the items that are not in the manifest but whose file, filename(item), is in dirname, from a single
+        listing of dirname: non-empty files as OK, and empty files, which marked missing items before the manifest,
+        as MISSING.
+        """
+        status = self.status(stage)
+        names = {filename(item): item for item in items if item not in status}
+        if not names or not os.path.isdir(dirname):
+            return
+        records = []
+        with os.scandir(dirname) as it:
+            for entry in it:
+                if entry.name in names:
+                    size = entry.stat().st_size
+                    records.append({'item': names[entry.name], 'status': self.OK if size else self.MISSING,
+                                    'size': size})
+        self.put(stage, records)
+
+    def adopt_store(self, stage, store, items):
+        """Same as adopt, for the items of a `figure_store.FigureStore`, whose sizes and hashes are known."""
+        status = self.status(stage)
+        stat = store.stat(item for item in items if item not in status)
+        self.put(stage, [{'item': item, 'status': self.OK if size else self.MISSING, 'size': size, 'hash': sha1}
+                         for item, (size, sha1) in stat.items()])